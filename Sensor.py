@@ -1,11 +1,29 @@
+import asyncio
 import serial
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from serial.tools import list_ports
+from collections import deque
+import binascii
+import math
+import os
+import struct
+import threading
 import time
 
+# Binary frame: sync bytes, uint16 sequence, 5 float32 readings, CRC-16/CCITT over sequence + readings
+FRAME_SYNC = b'\xa5\x5a'
+FRAME_BODY = struct.Struct('<H5f')
+FRAME_CRC = struct.Struct('<H')
+FRAME_SIZE = len(FRAME_SYNC) + FRAME_BODY.size + FRAME_CRC.size
+BINARY_COMMAND = b'B\n'  # Asks the firmware to switch to binary frames
+BINARY_ACK = b'BIN'
+
 class Sensor:
-    def __init__(self, port: str = "/dev/ttyACM0", baudrate: int = 9600):
-        """Initialize sensor matching Arduino's baud rate"""
+    def __init__(self, port: str = "/dev/ttyACM0", baudrate: int = 9600,
+                 binary: bool = False, binary_baudrate: int = 115200, queue_size: int = 1024):
+        """Initialize sensor matching Arduino's baud rate, optionally switching to binary frames"""
+        self.port = port
+        self.device = self.device_id(port)
         self.serial = serial.Serial(
             port=port,
             baudrate=baudrate,
@@ -20,8 +38,48 @@ class Sensor:
         self.serial.reset_input_buffer()
         self.serial.reset_output_buffer()
 
+        self._init_buffers(queue_size)
+        self.binary = binary and self._negotiate_binary(binary_baudrate)
+
+    def _init_buffers(self, queue_size: int) -> None:
+        """Decoder and handoff state, shared with sources that feed bytes without a serial port"""
+        self._rx = bytearray()  # Undecoded binary bytes
+        self._frames = deque()  # Decoded readings not yet returned
+        self._last_seq = None
+        self.crc_errors = 0
+        self.lost_frames = 0
+        self.binary = False
+
+        # Reader thread handoff: appends and pops on a deque are atomic, the event only wakes the consumer
+        self.queue_size = queue_size
+        self._queue = deque()
+        self._ready = threading.Event()
+        self._running = threading.Event()
+        self._thread = None
+        self._loop = None  # Event loop watching the port when started with start_async()
+        self._async_ready = None
+        self._line = bytearray()  # Partial text line carried over between reads
+        self.error = None
+        self.samples_read = 0
+        self.parse_errors = 0
+        self.overruns = 0
+
+    def _negotiate_binary(self, binary_baudrate: int) -> bool:
+        """Switch the firmware to binary frames, falls back to text if it does not answer"""
+        self.serial.write(BINARY_COMMAND)
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            if self.serial.readline().strip() == BINARY_ACK:
+                self.serial.baudrate = binary_baudrate
+                self.serial.reset_input_buffer()
+                return True
+        print("Sensor did not acknowledge binary mode, using text protocol")
+        return False
+
     def read(self) -> Tuple[Optional[float], ...]:
         """Efficient reading of sensor values"""
+        if self.binary:
+            return self._read_binary()
         try:
             if self.serial.in_waiting:
                 line = self.serial.readline().decode('ascii').strip()
@@ -34,15 +92,206 @@ class Sensor:
             print(f"Serial error: {e}")
         return (None,) * 5
 
+    def _read_binary(self) -> Tuple[Optional[float], ...]:
+        """Return the oldest decoded frame, reading more bytes only when none are buffered"""
+        if not self._frames:
+            try:
+                waiting = self.serial.in_waiting
+                if waiting:
+                    self._rx += self.serial.read(waiting)
+                    self._decode_frames()
+            except serial.SerialException as e:
+                self._rx.clear()
+                print(f"Serial error: {e}")
+        if self._frames:
+            return self._frames.popleft()
+        return (None,) * 5
+
+    def _decode_frames(self) -> None:
+        buffer = self._rx
+        pos = 0
+        with memoryview(buffer) as view:
+            while True:
+                pos = buffer.find(FRAME_SYNC, pos)
+                if pos < 0:
+                    # Keep a trailing sync byte that may be completed by the next read
+                    pos = len(buffer) - 1 if buffer.endswith(FRAME_SYNC[:1]) else len(buffer)
+                    break
+                if len(buffer) - pos < FRAME_SIZE:
+                    break
+                body_start = pos + len(FRAME_SYNC)
+                body_end = body_start + FRAME_BODY.size
+                (crc,) = FRAME_CRC.unpack_from(buffer, body_end)
+                if binascii.crc_hqx(view[body_start:body_end], 0xFFFF) != crc:
+                    # False sync or corrupted frame, resynchronize on the next byte
+                    self.crc_errors += 1
+                    pos += 1
+                    continue
+                seq, *values = FRAME_BODY.unpack_from(buffer, body_start)
+                if self._last_seq is not None:
+                    self.lost_frames += (seq - self._last_seq - 1) & 0xFFFF
+                self._last_seq = seq
+                if all(map(math.isfinite, values)):
+                    self._frames.append(tuple(values))
+                else:
+                    self.parse_errors += 1  # nan/inf from a faulty probe would poison every bucket it reaches
+                pos += FRAME_SIZE
+        del buffer[:pos]
+
+    def start(self) -> None:
+        """Start the background reader thread, samples are then taken with get()"""
+        if self._thread is None:
+            self._running.set()
+            self._thread = threading.Thread(target=self._reader_loop, daemon=True)
+            self._thread.start()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Tuple[float, Tuple[float, ...]]]:
+        """Oldest (epoch timestamp, readings) pair from the reader thread, or None on timeout"""
+        while True:
+            try:
+                return self._queue.popleft()
+            except IndexError:
+                pass
+            if self.error is not None:
+                raise self.error
+            if not self._running.is_set():
+                raise serial.SerialException("Sensor reader is not running")
+            self._ready.clear()
+            if self._queue:
+                continue
+            if not self._ready.wait(timeout):
+                return None
+
+    def stats(self) -> dict:
+        """Reader counters for monitoring"""
+        return {
+            'samples_read': self.samples_read,
+            'parse_errors': self.parse_errors,
+            'crc_errors': self.crc_errors,
+            'lost_frames': self.lost_frames,
+            'overruns': self.overruns,
+            'queue_depth': len(self._queue),
+        }
+
+    def _push(self, arrival: float, values: Tuple[float, ...]) -> None:
+        if len(self._queue) >= self.queue_size:
+            # Consumer is behind, drop the oldest sample rather than block the port
+            self.overruns += 1
+            try:
+                self._queue.popleft()
+            except IndexError:
+                pass
+        self._queue.append((arrival, values))
+        self.samples_read += 1
+        self._ready.set()
+
+    def _feed(self, chunk: bytes, arrival: float) -> None:
+        """Decode received bytes and queue every complete sample, partial data is kept for the next chunk"""
+        if self.binary:
+            self._rx += chunk
+            self._decode_frames()
+            while self._frames:
+                self._push(arrival, self._frames.popleft())
+            return
+
+        self._line += chunk
+        while True:
+            end = self._line.find(b'\n')
+            if end < 0:
+                return  # Mid-line, the rest arrives with the next read
+            line = bytes(self._line[:end + 1])
+            del self._line[:end + 1]
+            try:
+                values = tuple(map(float, line.decode('ascii').split(',')))
+            except (ValueError, UnicodeDecodeError):
+                self.parse_errors += 1
+                continue
+            if len(values) != 5 or not all(map(math.isfinite, values)):
+                self.parse_errors += 1  # nan/inf from a faulty probe would poison every bucket it reaches
+                continue
+            self._push(arrival, values)
+
+    def _reader_loop(self) -> None:
+        try:
+            while self._running.is_set():
+                if self.binary:
+                    chunk = self.serial.read(self.serial.in_waiting or 1)  # Blocks up to the port timeout
+                else:
+                    chunk = self.serial.readline()
+                arrival = time.time()  # Wall clock read per chunk, so clock steps (NTP) apply at once
+                if chunk:
+                    self._feed(chunk, arrival)
+        except serial.SerialException as e:
+            print(f"Serial error: {e}")
+            self.error = e
+            self._running.clear()
+            self._ready.set()
+
+    def start_async(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Read on loop instead of a thread, samples are then taken with aget().
+
+        The port is watched with loop.add_reader, so a device costs no thread.
+        Needs a selector event loop and a serial port with a file descriptor (POSIX).
+        """
+        if self._loop is None and self._thread is None:
+            self.serial.timeout = 0  # Reads return whatever is buffered
+            self._running.set()
+            self._loop = loop
+            self._async_ready = asyncio.Event()
+            loop.add_reader(self.serial.fileno(), self._on_readable)
+
+    def _on_readable(self) -> None:
+        try:
+            chunk = self.serial.read(self.serial.in_waiting or 1)
+            if chunk:
+                self._feed(chunk, time.time())
+        except serial.SerialException as e:
+            print(f"Serial error: {e}")
+            self.error = e
+            self._running.clear()
+            self._loop.remove_reader(self.serial.fileno())
+        self._async_ready.set()
+
+    async def aget(self, timeout: Optional[float] = None) -> Optional[Tuple[float, Tuple[float, ...]]]:
+        """get() for a sensor started with start_async(), waits without blocking the loop"""
+        while True:
+            sample = self.get(timeout=0)
+            if sample is not None:
+                return sample
+            self._async_ready.clear()
+            try:
+                await asyncio.wait_for(self._async_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
     def close(self) -> None:
-        """Clean up serial connection"""
+        """Stop the reader thread and clean up serial connection"""
+        if getattr(self, '_loop', None) is not None:
+            self._running.clear()
+            if self.serial.is_open:
+                self._loop.remove_reader(self.serial.fileno())
+            self._loop = None
+        if getattr(self, '_thread', None) is not None:
+            self._running.clear()
+            if self._thread is not threading.current_thread():
+                self._thread.join(timeout=1)
+            self._thread = None
         if hasattr(self, 'serial') and self.serial.is_open:
             self.serial.close()
 
+    @staticmethod
+    def device_id(port: str) -> str:
+        """Short id stored with every row of a device, e.g. ttyACM0 for /dev/ttyACM0"""
+        return os.path.basename(port)
+
+    @staticmethod
+    def find_arduino_ports() -> List[str]:
+        """Auto-detect every connected Arduino port, sorted by device path"""
+        return sorted(port.device for port in list_ports.comports()
+                      if 'Arduino' in port.description or 'ACM' in port.device)
+
     @staticmethod
     def find_arduino_port() -> Optional[str]:
         """Auto-detect Arduino port"""
-        for port in list_ports.comports():
-            if 'Arduino' in port.description or 'ACM' in port.device:
-                return port.device
-        return None
\ No newline at end of file
+        ports = Sensor.find_arduino_ports()
+        return ports[0] if ports else None
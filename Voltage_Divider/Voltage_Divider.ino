@@ -36,6 +36,18 @@ void calculatePower() {
 }
 */
 
+// Serial protocol: text lines at 9600 baud until the host sends 'B',
+// then fixed-size binary frames at a higher baud and sample rate
+const long TEXT_BAUD = 9600;
+const long BINARY_BAUD = 115200;
+const unsigned long TEXT_PERIOD_MS = 1000;
+const unsigned long BINARY_PERIOD_MS = 20;  // 50 Hz
+const uint8_t FRAME_SYNC1 = 0xA5;
+const uint8_t FRAME_SYNC2 = 0x5A;
+bool binaryMode = false;
+uint16_t frameSeq = 0;
+unsigned long lastSampleTime = 0;
+
 // Simulated power value (reasonable for a chiller system)
 float simulatedPower = 25000.0; // Starting at 25kW
 
@@ -64,8 +76,48 @@ float calculateTemperature(float resistance) {
     return steinhart;
 }
 
+// CRC-16/CCITT (poly 0x1021, init 0xFFFF), matches binascii.crc_hqx on the host
+uint16_t crc16(const uint8_t *data, size_t length) {
+    uint16_t crc = 0xFFFF;
+    for (size_t i = 0; i < length; i++) {
+        crc ^= (uint16_t)data[i] << 8;
+        for (uint8_t bit = 0; bit < 8; bit++) {
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+        }
+    }
+    return crc;
+}
+
+// Frame layout: A5 5A | seq (uint16 LE) | 5 x float32 LE | CRC16 LE over seq + floats
+void sendFrame(float t1, float t2, float p1, float p2, float power) {
+    uint8_t frame[26];
+    float values[5] = {t1, t2, p1, p2, power};
+    frame[0] = FRAME_SYNC1;
+    frame[1] = FRAME_SYNC2;
+    frame[2] = frameSeq & 0xFF;
+    frame[3] = frameSeq >> 8;
+    memcpy(frame + 4, values, sizeof(values));  // AVR floats are IEEE 754 little-endian
+    uint16_t crc = crc16(frame + 2, 22);
+    frame[24] = crc & 0xFF;
+    frame[25] = crc >> 8;
+    Serial.write(frame, sizeof(frame));
+    frameSeq++;
+}
+
+// Switch to binary frames when the host asks for it
+void checkCommand() {
+    if (!binaryMode && Serial.available() && Serial.read() == 'B') {
+        Serial.println("BIN");
+        Serial.flush();
+        Serial.end();
+        Serial.begin(BINARY_BAUD);
+        binaryMode = true;
+        lastSampleTime = millis();
+    }
+}
+
 void setup() {
-    Serial.begin(9600);
+    Serial.begin(TEXT_BAUD);
     
     // Power monitoring setup (commented out)
     /*
@@ -75,6 +127,14 @@ void setup() {
 }
 
 void loop() {
+    checkCommand();
+
+    unsigned long period = binaryMode ? BINARY_PERIOD_MS : TEXT_PERIOD_MS;
+    if (millis() - lastSampleTime < period) {
+        return;
+    }
+    lastSampleTime += period;
+
     // Read values from sensors
     sensorValue1 = analogRead(analogPin1);
     sensorValue2 = analogRead(analogPin2);
@@ -106,10 +166,15 @@ void loop() {
     */
 
     // Instead, use simulated power value
-    simulatedPower += random(-500, 500);  // Add random variation
+    simulatedPower += random(-500, 500) * (period / 1000.0);  // Add random variation, scaled to the sample period
     if (simulatedPower < 20000) simulatedPower = 20000;  // Min 20kW
     if (simulatedPower > 30000) simulatedPower = 30000;  // Max 30kW
 
+    if (binaryMode) {
+        sendFrame(temp1, temp2, pres1, pres2, simulatedPower);
+        return;
+    }
+
     // Send data: T1,T2,Pres1,Pres2,Power
     Serial.print(temp1, 1);
     Serial.print(",");
@@ -120,6 +185,4 @@ void loop() {
     Serial.print(pres2, 1);
     Serial.print(",");
     Serial.println(simulatedPower, 1);
-
-    delay(1000); // Wait for a second before next reading
 }
\ No newline at end of file
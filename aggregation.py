@@ -0,0 +1,123 @@
+import base64
+import math
+from typing import Dict, Optional
+
+from sketch import SKETCH_COLUMNS, SKETCH_METRICS, QuantileSketch, sketch_columns
+
+# Metrics averaged into every aggregated row, in the column order of the metrics table
+METRICS = ('temp1', 'temp2', 'pressure1', 'pressure2', 'power',
+           'kw_ton', 'cooling_tons', 'flow_rate')
+
+class RunningStats:
+    """Constant-memory count/mean/variance/min/max of a stream (Welford)"""
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'RunningStats') -> None:
+        """Combine another accumulator into this one (Chan et al.)"""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def total(self) -> float:
+        return self.mean * self.count
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / self.count) if self.count > 1 else 0.0
+
+class Bucket:
+    """Running statistics for every metric over one aggregation interval, plus quantile sketches of SKETCH_METRICS"""
+    __slots__ = ('start', 'seconds', 'stats', 'sketches')
+
+    def __init__(self, start: float, seconds: int):
+        self.start = start  # Epoch seconds, aligned to the interval
+        self.seconds = seconds
+        self.stats = {metric: RunningStats() for metric in METRICS}
+        self.sketches = {metric: QuantileSketch() for metric in SKETCH_METRICS}
+
+    @property
+    def end(self) -> float:
+        return self.start + self.seconds
+
+    @property
+    def count(self) -> int:
+        return self.stats[METRICS[0]].count
+
+    def add(self, metrics: Dict[str, float]) -> None:
+        # The sensor drops nan/inf readings, this also keeps out derived values that overflowed,
+        # so one bad sample cannot turn the means of this bucket and all it cascades into NaN
+        if not all(math.isfinite(metrics[metric]) for metric in METRICS):
+            return
+        for metric in SKETCH_METRICS:
+            self.sketches[metric].add(metrics[metric])
+        for metric in METRICS:
+            self.stats[metric].add(metrics[metric])
+
+    def merge(self, other: 'Bucket') -> None:
+        for metric in METRICS:
+            self.stats[metric].merge(other.stats[metric])
+        for metric in SKETCH_METRICS:
+            self.sketches[metric].merge(other.sketches[metric])
+
+    def to_state(self) -> dict:
+        """JSON-serializable copy of the running totals, see from_state"""
+        return {
+            'start': self.start,
+            'seconds': self.seconds,
+            'stats': {metric: [s.count, s.mean, s.m2, s.min, s.max] for metric, s in self.stats.items()},
+            'sketches': {metric: base64.b64encode(sketch.to_bytes()).decode('ascii')
+                         for metric, sketch in self.sketches.items()},
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'Bucket':
+        bucket = cls(state['start'], state['seconds'])
+        for metric in METRICS:
+            s = bucket.stats[metric]
+            s.count, s.mean, s.m2, s.min, s.max = state['stats'][metric]
+        # Checkpoints saved before sketches existed resume with empty ones
+        for metric, encoded in state.get('sketches', {}).items():
+            if metric in bucket.sketches:
+                bucket.sketches[metric] = QuantileSketch.from_bytes(base64.b64decode(encoded))
+        return bucket
+
+    def summary(self) -> Optional[dict]:
+        """Mean of every metric plus min/max/std and the SKETCH_COLUMNS values, or None for an empty bucket"""
+        if self.count == 0:
+            return None
+        result = {metric: self.stats[metric].mean for metric in METRICS}
+        result.update(zip(SKETCH_COLUMNS, sketch_columns(self.sketches)))
+        result['num_points'] = self.count
+        result['stats'] = {
+            metric: {'min': s.min, 'max': s.max, 'std': s.std}
+            for metric, s in self.stats.items()
+        }
+        return result
@@ -0,0 +1,178 @@
+import asyncio
+import io
+import json
+import sys
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote
+
+MAX_HEADER_LINES = 100
+MAX_BODY_BYTES = 1 << 20
+
+class BadRequest(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class Request:
+    """Parsed HTTP request handed to native asyncio handlers"""
+    __slots__ = ('method', 'path', 'query_string', 'headers', 'body', 'peer')
+
+    def __init__(self, method: str, path: str, query_string: str, headers: Dict[str, str],
+                 body: bytes, peer: Optional[tuple]):
+        self.method = method
+        self.path = path
+        self.query_string = query_string
+        self.headers = headers  # Lower-case names
+        self.body = body
+        self.peer = peer
+
+    @property
+    def args(self) -> Dict[str, str]:
+        """Query parameters, first value of each like Flask's request.args.get"""
+        return {name: values[0] for name, values in parse_qs(self.query_string).items()}
+
+Handler = Callable[[Request, asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]
+
+async def send_response(writer: asyncio.StreamWriter, status: int, headers: List[Tuple[str, str]],
+                        body: bytes = b'') -> None:
+    """Write a complete response, the connection is closed afterwards"""
+    head = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+    head += [f'{name}: {value}' for name, value in headers
+             if name.lower() not in ('connection', 'content-length', 'transfer-encoding')]
+    head += [f'Content-Length: {len(body)}', 'Connection: close', '', '']
+    writer.write('\r\n'.join(head).encode('latin-1') + body)
+    await writer.drain()
+
+async def send_json(writer: asyncio.StreamWriter, status: int, data) -> None:
+    await send_response(writer, status, [('Content-Type', 'application/json')], json.dumps(data).encode())
+
+class HTTPServer:
+    def __init__(self, wsgi_app, routes: Optional[Dict[str, Handler]] = None, executor=None):
+        """Minimal HTTP/1.1 front end on an asyncio event loop.
+
+        Paths in routes are served by coroutines on the loop, which suits
+        long-lived streams. Every other request goes to the WSGI application
+        in an executor thread, so blocking Flask views never stall the loop.
+        One request per connection.
+        """
+        self.wsgi_app = wsgi_app
+        self.routes = routes or {}
+        self.executor = executor
+        self._server_address = ('', 0)
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self._handle, host, port)
+        self._server_address = (host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await self._read_request(reader, writer.get_extra_info('peername'))
+            if request is None:
+                return
+            handler = self.routes.get(request.path)
+            if handler is not None:
+                await handler(request, reader, writer)
+                return
+            await self._respond_wsgi(request, writer)
+        except BadRequest as e:
+            await send_json(writer, e.status, {"status": "error", "message": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass  # Client went away
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader, peer) -> Optional[Request]:
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400, "Malformed request line")
+
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise BadRequest(431, "Too many headers")
+
+        if 'transfer-encoding' in headers:
+            raise BadRequest(411, "Chunked request bodies are not supported")
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequest(400, "Invalid Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise BadRequest(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b''
+
+        path, _, query_string = target.partition('?')
+        return Request(method.upper(), path, query_string, headers, body, peer)
+
+    async def _respond_wsgi(self, request: Request, writer: asyncio.StreamWriter) -> None:
+        """Run the WSGI application and send its response, streamed if it has more than one chunk"""
+        loop = asyncio.get_running_loop()
+        status, headers, result = await loop.run_in_executor(self.executor, self._call_wsgi, request)
+        chunks = iter(result)
+        try:
+            # Iterating may run the view's generator, so every step happens in the executor too
+            first = await loop.run_in_executor(self.executor, next, chunks, None)
+            second = await loop.run_in_executor(self.executor, next, chunks, None) if first is not None else None
+            if second is None:
+                await send_response(writer, status, headers, first or b'')
+                return
+
+            # No Content-Length, the body ends when the connection closes
+            head = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+            head += [f'{name}: {value}' for name, value in headers
+                     if name.lower() not in ('connection', 'content-length', 'transfer-encoding')]
+            head += ['Connection: close', '', '']
+            writer.write('\r\n'.join(head).encode('latin-1') + first)
+            chunk = second
+            while chunk is not None:
+                writer.write(chunk)
+                await writer.drain()  # Holds the next chunk back until a slow client caught up
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+    def _call_wsgi(self, request: Request) -> Tuple[int, List[Tuple[str, str]], Iterable[bytes]]:
+        host, port = self._server_address
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(request.path, encoding='latin-1'),
+            'QUERY_STRING': request.query_string,
+            'CONTENT_TYPE': request.headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(request.body)),
+            'SERVER_NAME': host or 'localhost',
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': request.peer[0] if request.peer else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        result = self.wsgi_app(environ, start_response)
+        return response['status'], response['headers'], result
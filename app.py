@@ -1,130 +1,159 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, g
 import sqlite3
+import queue
 from datetime import datetime, timedelta
 import time
-from threading import Thread
-from collections import defaultdict
+from threading import Lock, Thread
+from collections import defaultdict, deque
 from Sensor import Sensor
+from sources import device_id, make_source, open_sensor
+from storage import Storage, DB_PATH, format_timestamp, parse_timestamp
+from schema import migrate
+from aggregation import Bucket
+from archive import SampleArchive, RAW_FIELDS
+from calibration import FlowCalibration
+from recompute import Recomputer
+from scheduler import BucketScheduler
+from samples import SampleBuffer
+from stream import Broadcaster
+from aioserver import HTTPServer, send_json
+from cache import RecentCache, ROW_FIELDS, PERCENTILE_FIELDS
+from summary import RollingSummary, SUMMARY_WINDOWS
+from sketch import SKETCH_COLUMNS, SKETCH_METRICS, SKETCH_PERCENTILES, merge_stored
+from instrumentation import registry, SamplingProfiler
+from export import EXPORT_FORMATS, export_batches, csv_chunks, parquet_chunks, pa
+from history import (HISTORY_METRICS, ROLLUP_TIERS, ROLLUP_RETENTION_DAYS, update_rollup_source,
+                     ROLLUP_UPSERT, rollup_params, choose_tier, downsample)
 import math
+import re
+import asyncio
+import functools
+import sys
+import os
+import json
 
 #Flask app
 app = Flask(__name__)
-aggregator = None # DataAggregator object
-
-def init_db(): # Initialize the database
-    conn = sqlite3.connect('metrics.db')
-    c = conn.cursor()
-
-    # Drop existing tables to ensure clean schema
-    c.execute('DROP TABLE IF EXISTS metrics') 
-    c.execute('DROP TABLE IF EXISTS config')
-
-    # Create metrics table
-    c.execute('''CREATE TABLE metrics
-    (timestamp TEXT NOT NULL,
-    temp1 REAL NOT NULL,
-    temp2 REAL NOT NULL,
-    pressure1 REAL NOT NULL,
-    pressure2 REAL NOT NULL,
-    power REAL NOT NULL,
-    kw_ton REAL NOT NULL,
-    cooling_tons REAL NOT NULL,
-    flow_rate REAL NOT NULL,
-    interval TEXT NOT NULL)''')
-
-    c.execute('CREATE INDEX idx_timestamp_interval ON metrics(timestamp, interval)') # Index for faster queries
-
-    c.execute('''CREATE TABLE config
-    (id INTEGER PRIMARY KEY,
-    interval1_seconds INTEGER NOT NULL CHECK(interval1_seconds > 0),
-    interval2_seconds INTEGER NOT NULL CHECK(interval2_seconds > 0),
-    interval3_seconds INTEGER NOT NULL CHECK(interval3_seconds > 0),
-    retention_interval1 INTEGER NOT NULL CHECK(retention_interval1 > 0),
-    retention_interval2 INTEGER NOT NULL CHECK(retention_interval2 > 0),
-    retention_interval3 INTEGER NOT NULL CHECK(retention_interval3 > 0))''') # Configuration table
-
-    c.execute('''INSERT INTO config VALUES
-    (1, 60, 900, 3600, 1, 7, 30)''') # Default configuration
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS calibration_points
-        (id INTEGER PRIMARY KEY,
-        pressure_diff REAL NOT NULL,
-        flow_rate REAL NOT NULL,
-        timestamp TEXT NOT NULL)''')
-
-    conn.commit() 
+aggregators = {} # DataAggregator per device id
+archives = {} # SampleArchive per device id, when raw samples are archived
+storage = None # Storage object, owns the database connection
+broadcaster = Broadcaster() # Pushes live samples and aggregates to /stream clients
+recent = RecentCache(500) # Newest aggregated rows per interval, served without touching SQLite
+summaries = RollingSummary() # Rolling KPI statistics per device, served by /summary
+recomputer = None # Rewrites stored derived metrics after a recalibration
+rollup_interval = None # Interval whose rows feed the daily rollups, chosen from the configured intervals
+sensors = {} # Open Sensor per device id, read when /metrics is scraped
+profiler = SamplingProfiler() # Off until switched on through /profile or --profile
+
+# Metrics of the logger itself, served by /metrics. Sensor counters restart from zero when a port is reopened.
+SENSOR_COUNTERS = {
+    'samples_read': 'Samples decoded from the sensor',
+    'parse_errors': 'Lines or frames that could not be decoded',
+    'crc_errors': 'Binary frames with a bad checksum',
+    'lost_frames': 'Binary frames missing from the sequence numbers',
+    'overruns': 'Samples dropped because the collector fell behind',
+}
+CLEANUP_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800)  # seconds, vacuum pauses included
+
+# Values of one Sensor.stats() entry per device, at scrape time
+def sensor_stat(name):
+    return lambda: {(device,): sensor.stats()[name] for device, sensor in list(sensors.items())}
+
+for stat, description in SENSOR_COUNTERS.items():
+    registry.counter(f'logger_sensor_{stat}_total', description, ('device',), collect=sensor_stat(stat))
+registry.gauge('logger_sensor_queue_depth', 'Samples read but not yet taken by the collector', ('device',),
+               collect=sensor_stat('queue_depth'))
+registry.gauge('logger_storage_queue_depth', 'Statements waiting for the next storage flush',
+               collect=lambda: {(): storage.pending} if storage is not None else {})
+registry.counter('logger_late_samples_total', 'Samples that arrived after their bucket was closed', ('device',),
+                 collect=lambda: {(device,): aggregator.late_samples for device, aggregator in list(aggregators.items())})
+RECONNECTS = registry.counter('logger_sensor_reconnects_total', 'Times a collector closed its sensor to reopen it',
+                              ('device',))
+COLLECTOR_ERRORS = registry.counter('logger_collector_errors_total', 'Exceptions caught by a collector loop',
+                                    ('device', 'error'))
+BUCKET_CLOSE_LAG = registry.histogram('logger_bucket_close_lag_seconds',
+                                      'Time from the end of a bucket until its row is queued', ('interval',))
+CLEANUP_SECONDS = registry.histogram('logger_cleanup_seconds', 'Duration of one retention pass',
+                                     buckets=CLEANUP_BUCKETS)
+CLEANUP_ERRORS = registry.counter('logger_cleanup_errors_total', 'Retention passes that failed')
+REQUEST_SECONDS = registry.histogram('logger_http_request_seconds',
+                                     'Time to answer an HTTP request, streamed bodies excluded',
+                                     ('route', 'method', 'status'))
+
+def init_db(): # Initialize or migrate the database, stored data is kept
+    conn = sqlite3.connect(DB_PATH)
+    migrate(conn)
     conn.close()
 
-class FlowCalibration:
-    def __init__(self):
-        self.m = 0.5  # Default slope
-        self.b = 0    # Default intercept
-        self.a = 1    # Default coefficient
-        self._load_calibration()
-        
-    def _load_calibration(self):
-        with sqlite3.connect('metrics.db') as conn:
-            c = conn.cursor()
-            c.execute('''SELECT pressure_diff, flow_rate 
-                        FROM calibration_points 
-                        ORDER BY timestamp DESC LIMIT 2''')
-            points = c.fetchall()
-            
-            if len(points) == 2:
-                x1, y1 = points[0]  # pressure_diff, flow_rate
-                x2, y2 = points[1]
-                
-                if x1 > 0 and x2 > 0 and y1 > 0 and y2 > 0:
-                    # Calculate m (slope) and b (intercept) in log space
-                    self.m = math.log(y2/y1) / math.log(x2/x1)
-                    self.b = math.log(y1) - self.m * math.log(x1)
-                    # Calculate coefficient a = e^b
-                    self.a = math.exp(self.b)
-    
-    def calculate_flow_rate(self, pressure_diff):
-        if pressure_diff <= 0:
-            return 0
-        return self.a * (pressure_diff ** self.m)
+# Configured aggregation intervals as (name, seconds, retention_days), shortest first
+def load_intervals():
+    return storage.query('SELECT name, seconds, retention_days FROM intervals ORDER BY seconds, name')
+
+# Known devices as (id, port), every device that ever stored a row
+def load_devices():
+    return storage.query('SELECT id, port FROM devices ORDER BY id')
 
 class DataAggregator:
-    def __init__(self, sampling_rate_seconds):
-        self.data_points = defaultdict(list)
-        current_time = datetime.now()
-        self.last_aggregation = {
-            'interval1': self._floor_timestamp(current_time, 60),
-            'interval2': self._floor_timestamp(current_time, 900),
-            'interval3': self._floor_timestamp(current_time, 3600)
-        }
+    def __init__(self, sampling_rate_seconds, storage, close_grace=0.25):
+        self.storage = storage
+        self.buckets = {} # Open bucket per interval, updated in place
+        self.closed = defaultdict(deque) # Finished buckets waiting to be stored
+        self.closed_until = {} # Epoch end of the last bucket closed per interval, older samples are late
+        self.late_samples = 0 # Samples that arrived after their bucket was closed
+        self.samples = SampleBuffer(RAW_BUFFER_SECONDS) # Raw samples of the last RAW_BUFFER_SECONDS, for /raw
+        self.scheduler = None # Timer closing buckets at their wall-clock boundaries
+        self.close_grace = close_grace
+        self.last_aggregation = {} # Epoch label of the last row produced per interval
+        self.intervals = {} # Interval name -> seconds, shortest first
+        self.raw_intervals = [] # Intervals fed directly from samples
+        self.cascades = {} # Interval name -> coarser intervals built from its closed buckets
         self.sampling_rate = sampling_rate_seconds
-        self.max_points = self._get_max_points()
-        self.calibration = FlowCalibration()
-    
-    # Get the maximum number of data points to store
-    def _get_max_points(self):
-        with sqlite3.connect('metrics.db') as conn:
-            c = conn.cursor()
-            c.execute('''SELECT 
-                retention_interval1, interval1_seconds,
-                retention_interval2, interval2_seconds,
-                retention_interval3, interval3_seconds 
-                FROM config WHERE id = 1''')
-            config = c.fetchone()
-            
-            if not config:
-                return {'interval1': 1000, 'interval2': 1000, 'interval3': 1000}
-            
-            return {
-                'interval1': (config[0] * 24 * 3600) // config[1],
-                'interval2': (config[2] * 24 * 3600) // config[3],
-                'interval3': (config[4] * 24 * 3600) // config[5]
-            }
-    # Update the maximum number of data points
-    def update_max_points(self):
-        self.max_points = self._get_max_points()
+        self.lock = Lock() # Held while the buckets are read or changed, /config reloads from a request thread
+        self.update_config()
+        self.calibration = FlowCalibration(storage)
+    
+    # Get the interval lengths
+    def _load_config(self):
+        rows = self.storage.query('SELECT name, seconds FROM intervals ORDER BY seconds, name')
+        
+        if not rows:
+            raise ValueError("Configuration not found")
+        
+        return dict(rows)
+
+    # Each interval is built from the longest finer interval that divides it, or from raw samples if there is none
+    @staticmethod
+    def _plan_cascades(intervals):
+        raw_intervals = []
+        cascades = {name: [] for name in intervals}
+        for name, seconds in intervals.items():
+            sources = [finer for finer, finer_seconds in intervals.items()
+                       if finer_seconds < seconds and seconds % finer_seconds == 0]
+            if sources:
+                cascades[sources[-1]].append(name)
+            else:
+                raw_intervals.append(name)
+        return raw_intervals, cascades
+
+    # Reload the configuration, called once at startup and after every change
+    def update_config(self):
+        intervals = self._load_config()
+        with self.lock:
+            # Buckets of an interval that was removed or changed length are closed as they are, finest first
+            for interval_name, seconds in self.intervals.items():
+                if intervals.get(interval_name) != seconds:
+                    self._close_bucket(interval_name)
+                    self.closed_until.pop(interval_name, None)
+                    if interval_name not in intervals:
+                        # Its samples still reach the coarser intervals, but a removed interval stores no new rows
+                        self.closed.pop(interval_name, None)
+            self.intervals = intervals
+            self.raw_intervals, self.cascades = self._plan_cascades(intervals)
+            self.scheduler = BucketScheduler(intervals, self.close_grace)
     
-    # Add a new data point
-    def add_data_point(self, temp1, temp2, pressure1, pressure2, power):
-        timestamp = datetime.now()
+    # Add a new data point, timestamp is the epoch time the sample arrived
+    def add_data_point(self, temp1, temp2, pressure1, pressure2, power, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
         diff_pressure = abs(pressure1 - pressure2)
         
         # Use calibration for flow rate calculation
@@ -146,55 +175,119 @@ class DataAggregator:
             'flow_rate': flow_rate
         }
     
-        for interval in ['interval1', 'interval2', 'interval3']:
-            self.data_points[interval].append(metrics)
-            max_points = self.max_points[interval]
-            if len(self.data_points[interval]) > max_points:
-                self.data_points[interval] = self.data_points[interval][-max_points:]
-
-
-        
-    # Round down the timestamp to the nearest interval
-    def _floor_timestamp(self, dt, interval_seconds):
-        timestamp = dt.timestamp()
-        return datetime.fromtimestamp(timestamp - (timestamp % interval_seconds))
-    
-    # Get the aggregated data for a given interval
-    def get_aggregated_data(self, interval_name, interval_seconds):
-        current_time = datetime.now()
-        current_interval_start = self._floor_timestamp(current_time, interval_seconds)
-        
-        if current_interval_start <= self.last_aggregation[interval_name]:
+        # Keep the raw sample, then fold it into the running totals of the intervals fed from samples.
+        # Coarser intervals receive it when the finer bucket holding it closes.
+        with self.lock:
+            self.samples.append(timestamp, metrics)
+            late = False
+            for interval_name in self.raw_intervals:
+                bucket = self._bucket_for(interval_name, timestamp)
+                if bucket is None:
+                    late = True
+                else:
+                    bucket.add(metrics)
+            if late:
+                self.late_samples += 1
+    
+    # Open bucket of an interval covering epoch, or None if epoch is older than the open or last closed bucket
+    def _bucket_for(self, interval_name, epoch):
+        bucket = self.buckets.get(interval_name)
+        if bucket is not None and bucket.start <= epoch < bucket.end:
+            return bucket
+        if epoch < self.closed_until.get(interval_name, -math.inf) or (bucket is not None and epoch < bucket.start):
             return None
         
-        prev_interval_start = current_interval_start - timedelta(seconds=interval_seconds)
-        
-        interval_points = [
-            dp for dp in self.data_points[interval_name]
-            if prev_interval_start <= dp['timestamp'] < current_interval_start
-        ]
-        
-        if interval_points:
-            avg_data = {
-                'temp1': sum(dp['temp1'] for dp in interval_points) / len(interval_points),
-                'temp2': sum(dp['temp2'] for dp in interval_points) / len(interval_points),
-                'pressure1': sum(dp['pressure1'] for dp in interval_points) / len(interval_points),
-                'pressure2': sum(dp['pressure2'] for dp in interval_points) / len(interval_points),
-                'power': sum(dp['power'] for dp in interval_points) / len(interval_points),
-                'kw_ton': sum(dp['kw_ton'] for dp in interval_points) / len(interval_points),
-                'cooling_tons': sum(dp['cooling_tons'] for dp in interval_points) / len(interval_points),
-                'flow_rate': sum(dp['flow_rate'] for dp in interval_points) / len(interval_points),
-                'timestamp': current_interval_start
+        # Data past the open bucket's end closes it ahead of the timer
+        self._close_bucket(interval_name)
+        seconds = self.intervals[interval_name]
+        bucket = self.buckets[interval_name] = Bucket(epoch - (epoch % seconds), seconds)
+        return bucket
+    
+    # Move the open bucket of an interval to the closed queue and merge it into the coarser intervals built from it.
+    # Empty buckets produce no row.
+    def _close_bucket(self, interval_name):
+        bucket = self.buckets.pop(interval_name, None)
+        if bucket is None:
+            return
+        self.closed_until[interval_name] = bucket.end
+        if not bucket.count:
+            return
+        self.closed[interval_name].append(bucket)
+        for coarser in self.cascades.get(interval_name, ()):
+            target = self._bucket_for(coarser, bucket.start)
+            if target is None:
+                self.late_samples += bucket.count
+            else:
+                target.merge(bucket)
+    
+    # Save the open buckets of a device through the write-behind queue, cheap enough to run every few seconds
+    def save_checkpoint(self, device):
+        with self.lock:
+            state = {
+                'buckets': {name: bucket.to_state() for name, bucket in self.buckets.items()},
+                'closed_until': dict(self.closed_until),
             }
+        self.storage.enqueue('INSERT OR REPLACE INTO bucket_state (device, saved, state) VALUES (?, ?, ?)',
+                             (device, int(time.time()), json.dumps(state)))
+    
+    # Resume the buckets saved for a device before a restart. Buckets whose row was stored after the
+    # checkpoint, of removed intervals or of intervals that changed length are dropped.
+    def load_checkpoint(self, device):
+        row = self.storage.query_one('SELECT state FROM bucket_state WHERE device = ?', (device,))
+        if row is None:
+            return
+        state = json.loads(row[0])
+        for interval_name, until in state['closed_until'].items():
+            if interval_name in self.intervals:
+                self.closed_until[interval_name] = max(self.closed_until.get(interval_name, until), until)
+        for interval_name, bucket_state in state['buckets'].items():
+            bucket = Bucket.from_state(bucket_state)
+            if self.intervals.get(interval_name) != bucket.seconds:
+                continue
+            stored = self.storage.query_one('''SELECT 1 FROM metrics
+                                            WHERE interval = ? AND device = ? AND timestamp >= ?
+                                            LIMIT 1''', (interval_name, device, int(bucket.end)))
+            if stored is not None:
+                self.closed_until[interval_name] = max(self.closed_until.get(interval_name, bucket.end), bucket.end)
+                continue
+            # A bucket that ended while the process was down closes with the next sample or timer tick
+            self.buckets[interval_name] = bucket
+    
+    # Epoch time the next bucket close is due
+    def next_deadline(self):
+        with self.lock:
+            return self.scheduler.next_deadline()
+    
+    # End epoch of the newest open bucket, 0 before the first sample
+    def open_until(self):
+        with self.lock:
+            return max((bucket.end for bucket in self.buckets.values()), default=0)
+    
+    # Close buckets whose boundary has passed and return (interval_name, seconds, aggregated data) of every finished bucket
+    def close_due(self, now=None):
+        with self.lock:
+            due = dict(self.scheduler.due(now))
+            # Shortest first, so finer buckets are merged into a coarser one before it closes on the same boundary
+            for interval_name in self.intervals:
+                if interval_name not in due:
+                    continue
+                boundary = due[interval_name]
+                bucket = self.buckets.get(interval_name)
+                if bucket is not None and bucket.end <= boundary:
+                    self._close_bucket(interval_name)
+                elif bucket is None:
+                    # No samples in the bucket, later stragglers for it are late
+                    self.closed_until[interval_name] = max(self.closed_until.get(interval_name, boundary), boundary)
             
-            self.last_aggregation[interval_name] = current_interval_start
-            
-            self.data_points[interval_name] = [
-                dp for dp in self.data_points[interval_name]
-                if dp['timestamp'] >= prev_interval_start
-            ]
-            
-            return avg_data
+            results = []
+            for interval_name, closed in self.closed.items():
+                while closed:
+                    bucket = closed.popleft()
+                    avg_data = bucket.summary()
+                    avg_data['timestamp'] = int(bucket.end) # Rows are labelled with the end of their bucket, in epoch seconds
+                    self.last_aggregation[interval_name] = avg_data['timestamp']
+                    results.append((interval_name, bucket.seconds, avg_data))
+            return results
 # Configuration page
 @app.route('/calibration', methods=['POST'])
 def add_calibration_point():
@@ -203,64 +296,81 @@ def add_calibration_point():
         pressure_diff = float(data['pressure_diff'])
         flow_rate = float(data['flow_rate'])
         
-        with sqlite3.connect('metrics.db') as conn:
-            c = conn.cursor()
-            c.execute('''INSERT INTO calibration_points 
+        storage.execute('''INSERT INTO calibration_points 
                         (pressure_diff, flow_rate, timestamp) 
                         VALUES (?, ?, ?)''',
                      (pressure_diff, flow_rate, 
                       datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-            conn.commit()
-            
+
+        # Refit now so the next sample already uses the new point, then fix up the stored rows in the background
+        for aggregator in list(aggregators.values()):
+            aggregator.calibration.reload()
+        recomputer.request()
+
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# Progress of the job recomputing stored rows, POST starts it over with the current calibration
+@app.route('/recompute', methods=['GET', 'POST'])
+def recompute():
+    try:
+        if request.method == 'POST':
+            recomputer.request()
+            return jsonify({"status": "success"})
+        return jsonify(recomputer.progress() or {"status": "idle"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# End epoch of the newest bucket any collector still has open, 0 before the first sample
+def open_buckets_end():
+    return max((aggregator.open_until() for aggregator in list(aggregators.values())), default=0)
+
+# Reload the cached rows and rolling summaries, after a recompute rewrote them
+def refresh_recent():
+    intervals = load_intervals()
+    devices = [device for device, _ in load_devices()]
+    recent.warm(storage, [name for name, _, _ in intervals], devices)
+    summaries.warm(storage, intervals, devices, time.time())
+
+# Intervals are posted as {"intervals": [{"name": ..., "seconds": ..., "retention_days": ...}, ...]}
 @app.route('/config', methods=['GET', 'POST'])
 def config():
-    global aggregator
+    global rollup_interval
     # Update the configuration
     if request.method == 'POST':
         try:
             data = request.json # Get the JSON data
-            required_fields = [
-                'interval1_seconds', 'interval2_seconds',
-                'interval3_seconds', 'retention_interval1', 
-                'retention_interval2', 'retention_interval3'
-            ]
+            entries = data.get('intervals') if isinstance(data, dict) else None
             
-            if not all(field in data for field in required_fields):
+            if not entries or not all(isinstance(entry, dict) and
+                                      all(field in entry for field in ('name', 'seconds', 'retention_days'))
+                                      for entry in entries):
                 return jsonify({"status": "error", "message": "Missing required fields"}), 400
             
-            interval1_seconds = int(data['interval1_seconds'])
-            interval2_seconds = int(data['interval2_seconds'])
-            interval3_seconds = int(data['interval3_seconds'])
-            retention_interval1 = int(data['retention_interval1'])
-            retention_interval2 = int(data['retention_interval2'])
-            retention_interval3 = int(data['retention_interval3'])
+            rows = [(str(entry['name']), int(entry['seconds']), int(entry['retention_days'])) for entry in entries]
             
-            if any(x <= 0 for x in [interval1_seconds, interval2_seconds, interval3_seconds]):
+            # Names become part of partition table names
+            if not all(re.fullmatch(r'\w+', name) for name, _, _ in rows):
+                return jsonify({"status": "error", "message": "Interval names may only contain letters, digits and underscores"}), 400
+            if len({name for name, _, _ in rows}) != len(rows):
+                return jsonify({"status": "error", "message": "Interval names must be unique"}), 400
+            if any(seconds <= 0 for _, seconds, _ in rows):
                 return jsonify({"status": "error", "message": "Intervals must be positive"}), 400
-            if any(x <= 0 for x in [retention_interval1, retention_interval2, retention_interval3]):
+            if any(retention_days <= 0 for _, _, retention_days in rows):
                 return jsonify({"status": "error", "message": "Retention periods must be positive"}), 400
             
-            with sqlite3.connect('metrics.db') as conn:
-                c = conn.cursor()
-                c.execute('''UPDATE config SET 
-                            interval1_seconds = ?,
-                            interval2_seconds = ?,
-                            interval3_seconds = ?,
-                            retention_interval1 = ?,
-                            retention_interval2 = ?,
-                            retention_interval3 = ?
-                            WHERE id = 1''',
-                         (interval1_seconds, interval2_seconds,
-                          interval3_seconds, retention_interval1, retention_interval2,
-                          retention_interval3))
-                conn.commit()
+            with storage.transaction() as c:
+                c.execute('DELETE FROM intervals')
+                c.executemany('INSERT INTO intervals (name, seconds, retention_days) VALUES (?, ?, ?)', rows)
+                # The rollups follow the new intervals, rebuilt from another source if the choice changed
+                source = update_rollup_source(c)
+            rollup_interval = source
             
-            if aggregator:
-                aggregator.update_max_points()
+            for aggregator in list(aggregators.values()):
+                aggregator.update_config()
+            # Interval lengths decide which rows feed each summary window
+            summaries.warm(storage, load_intervals(), [device for device, _ in load_devices()], time.time())
                 
             return jsonify({"status": "success"})
             
@@ -268,178 +378,662 @@ def config():
             return jsonify({"status": "error", "message": str(e)}), 500
     
     # Get the current configuration
-    with sqlite3.connect('metrics.db') as conn:
-        c = conn.cursor()
-        c.execute('SELECT * FROM config WHERE id = 1')
-        config_data = c.fetchone()
+    intervals = load_intervals()
         
-    if config_data is None:
+    if not intervals:
         return jsonify({"status": "error", "message": "Configuration not found"}), 404
         
-    return render_template('config.html', 
-                         interval1_seconds=config_data[1],
-                         interval2_seconds=config_data[2],
-                         interval3_seconds=config_data[3],
-                         retention_interval1=config_data[4],
-                         retention_interval2=config_data[5],
-                         retention_interval3=config_data[6])
-
-def collect_data():
-    global aggregator 
+    return render_template('config.html', intervals=intervals)
+
+SENSOR_BINARY = '--binary' in sys.argv  # Negotiate binary frames (10-50 Hz) instead of 1 Hz text lines
+SAMPLE_PUSH_INTERVAL = 1  # seconds between raw samples pushed to /stream clients
+DEFAULT_PORT = '/dev/ttyACM0'  # Used when no board is detected at startup
+RAW_ARCHIVE = '--raw-archive' in sys.argv  # Also keep every raw sample, in binary segment files
+RAW_ARCHIVE_DIR = 'raw'  # One subdirectory per device
+RAW_RETENTION_DAYS = 28
+MAX_RAW_SAMPLES = 100000  # Per /raw request
+RAW_BUFFER_SECONDS = 3600  # Raw samples kept in memory per device, what /raw serves without --raw-archive
+CHECKPOINT_PERIOD = 5  # seconds between saves of the open buckets, matches the storage flush interval
+MIN_PROFILE_INTERVAL = 0.001  # seconds between profiler samples, shorter slows every thread down
+MAX_PROFILE_INTERVAL = 1.0
+
+# Raw sample archive of a device, the collector's own instance while it runs
+def archive_for(device):
+    return archives.get(device) or SampleArchive(os.path.join(RAW_ARCHIVE_DIR, device))
+
+# Record a board and the port it is on
+def register_device(device, port):
+    storage.execute('''INSERT INTO devices (id, port) VALUES (?, ?)
+                    ON CONFLICT (id) DO UPDATE SET port = excluded.port''', (device, port))
+
+# Queue, cache and push every bucket of a device that has closed.
+# Never blocks: the storage thread writes the queued rows in batches.
+def store_aggregates(device, aggregator):
+    for interval_name, seconds, avg_data in aggregator.close_due():
+        timestamp = avg_data['timestamp']
+        BUCKET_CLOSE_LAG.observe(max(0.0, time.time() - timestamp), interval=interval_name)
+        storage.insert_metrics(
+                (timestamp,
+                 avg_data['temp1'],
+                 avg_data['temp2'],
+                 avg_data['pressure1'],
+                 avg_data['pressure2'],
+                 avg_data['power'],
+                 avg_data['kw_ton'],
+                 avg_data['cooling_tons'],
+                 avg_data['flow_rate'],
+                 *(avg_data[column] for column in SKETCH_COLUMNS),
+                 device,
+                 interval_name))
+        # Same fields as a /data row
+        row = (timestamp,
+               avg_data['kw_ton'],
+               abs(avg_data['pressure1'] - avg_data['pressure2']),
+               abs(avg_data['temp1'] - avg_data['temp2']),
+               avg_data['cooling_tons'],
+               avg_data['flow_rate'],
+               *(avg_data[field] for field in PERCENTILE_FIELDS),
+               device)
+        recent.add(interval_name, row)
+        summaries.add(interval_name, device, timestamp, avg_data)
+        event = dict(zip(ROW_FIELDS, row))
+        if interval_name == rollup_interval:
+            for tier in ROLLUP_TIERS:
+                storage.enqueue(ROLLUP_UPSERT, rollup_params(tier, device, timestamp - seconds, event))
+        event['interval'] = interval_name
+        event['timestamp'] = format_timestamp(timestamp)
+        broadcaster.publish('aggregate', event, topic=interval_name, device=device)
+
+# Push the newest raw sample of a device to /stream clients
+def publish_sample(device, aggregator):
+    sample = aggregator.samples.latest()
+    sample['timestamp'] = format_timestamp(sample['timestamp'])
+    sample['device'] = device
+    broadcaster.publish('sample', sample, device=device)
+
+# Per-sample work of one board's collector, shared by the threaded and the asyncio runtime
+class Collector:
+    def __init__(self, device, aggregator, archive):
+        self.device = device
+        self.aggregator = aggregator
+        self.archive = archive
+        self.last_push = 0
+        self.last_checkpoint = time.time()
+
+    # Store the closed buckets and checkpoint the open ones, returns the seconds until the next bucket closes
+    def tick(self):
+        # Buckets close on a timer at their wall-clock boundaries, whether or not samples keep coming
+        store_aggregates(self.device, self.aggregator)
+        if time.time() - self.last_checkpoint >= CHECKPOINT_PERIOD:
+            self.last_checkpoint = time.time()
+            self.aggregator.save_checkpoint(self.device)
+        return max(0, self.aggregator.next_deadline() - time.time())
+
+    # Fold in an (arrival, readings) sample from the sensor, every sample counts, steady readings included
+    def add(self, sample):
+        arrival, (temp1, temp2, pressure1, pressure2, power) = sample
+        self.aggregator.add_data_point(temp1, temp2, pressure1, pressure2, 
+                                       power, arrival)
+        if self.archive is not None:
+            self.archive.append(arrival, sample[1])
+        
+        # Raw samples are throttled, at high sample rates browsers only need the latest one
+        if arrival - self.last_push >= SAMPLE_PUSH_INTERVAL:
+            self.last_push = arrival
+            publish_sample(self.device, self.aggregator)
+
+# One collector thread per board, rows are tagged with the board's device id
+def collect_data(port=DEFAULT_PORT):
     SAMPLING_RATE = 1  # seconds
-    sensor = Sensor()
-    aggregator = DataAggregator(SAMPLING_RATE)
-    
-    last_values = None
+    device = device_id(port)
+    register_device(device, port)
+    sensor = sensors[device] = open_sensor(port, binary=SENSOR_BINARY)
+    sensor.start()
+    aggregator = aggregators[device] = DataAggregator(SAMPLING_RATE, storage)
+    aggregator.load_checkpoint(device)
+    archive = archives[device] = archive_for(device) if RAW_ARCHIVE else None
+    collector = Collector(device, aggregator, archive)
 
     while True:
         try:
-            sensor_data = sensor.read()
-            
-            if len(sensor_data) != 5 or None in sensor_data:
-                time.sleep(0.1)
-                continue
-            
-            if sensor_data != last_values:
-                temp1, temp2, pressure1, pressure2, power = sensor_data
-                last_values = sensor_data
-                
-                with sqlite3.connect('metrics.db') as conn:
-                    c = conn.cursor()
-                    c.execute('''SELECT interval1_seconds, interval2_seconds, 
-                               interval3_seconds FROM config WHERE id = 1''')
-                    config = c.fetchone()
-                    
-                    if not config:
-                        raise ValueError("Configuration not found")
-                    
-                    interval1_seconds, interval2_seconds, interval3_seconds = config
-                    
-                    aggregator.add_data_point(temp1, temp2, pressure1, pressure2, 
-                                            power)
-                    
-                    intervals = [
-                        ('interval1', interval1_seconds),
-                        ('interval2', interval2_seconds),
-                        ('interval3', interval3_seconds)
-                    ]
-                    
-                    for interval_name, seconds in intervals:
-                        avg_data = aggregator.get_aggregated_data(interval_name, seconds)
-                        if avg_data:
-                            c.execute('''INSERT INTO metrics VALUES 
-                                    (?,?,?,?,?,?,?,?,?,?)''',
-                                    (avg_data['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
-                                     avg_data['temp1'],
-                                     avg_data['temp2'],
-                                     avg_data['pressure1'],
-                                     avg_data['pressure2'],
-                                     avg_data['power'],
-                                     avg_data['kw_ton'],
-                                     avg_data['cooling_tons'],
-                                     avg_data['flow_rate'],
-                                     interval_name))
-                            conn.commit()
+            # Blocks until the reader thread hands over a sample stamped at arrival or the next close is due
+            sample = sensor.get(timeout=collector.tick())
+            if sample is not None:
+                collector.add(sample)
                 
-        except Exception:
+        except Exception as e:
+            print(f"Collector {device} failed: {e!r}, reopening {port}")
+            COLLECTOR_ERRORS.inc(device=device, error=type(e).__name__)
             try:
                 sensor.close()
+                RECONNECTS.inc(device=device)
                 time.sleep(1)
-                sensor = Sensor()
-            except Exception:
+                sensor = sensors[device] = open_sensor(port, binary=SENSOR_BINARY)
+                sensor.start()
+            except Exception as e:
+                print(f"Reopening {port} failed: {e!r}")
                 time.sleep(5)
-        
-        time.sleep(SAMPLING_RATE)
+
+# Collector for the asyncio runtime: the port is watched by the event loop, no thread per board
+async def collect_data_async(port=DEFAULT_PORT):
+    SAMPLING_RATE = 1  # seconds
+    loop = asyncio.get_running_loop()
+    device = device_id(port)
+    await loop.run_in_executor(None, register_device, device, port)
+    aggregator = aggregators[device] = await loop.run_in_executor(None, DataAggregator, SAMPLING_RATE, storage)
+    await loop.run_in_executor(None, aggregator.load_checkpoint, device)
+    archive = archives[device] = archive_for(device) if RAW_ARCHIVE else None
+    collector = Collector(device, aggregator, archive)
+    sensor = None
+    
+    while True:
+        try:
+            if sensor is None:
+                # Opening waits for the board to reset, keep that off the loop
+                sensor = await loop.run_in_executor(None, functools.partial(open_sensor, port, binary=SENSOR_BINARY))
+                sensors[device] = sensor
+                sensor.start_async(loop)
+            
+            timeout = collector.tick()
+            # No flush thread runs here, so a full queue is written without waiting for flush_periodically
+            if storage.pending >= storage.flush_size:
+                await loop.run_in_executor(None, storage.flush)
+            sample = await sensor.aget(timeout)
+            if sample is not None:
+                collector.add(sample)
+                
+        except Exception as e:
+            print(f"Collector {device} failed: {e!r}, reopening {port}")
+            COLLECTOR_ERRORS.inc(device=device, error=type(e).__name__)
+            if sensor is not None:
+                sensor.close()
+                sensor = None
+                RECONNECTS.inc(device=device)
+                await asyncio.sleep(1)
+            else:
+                await asyncio.sleep(5)
 
 @app.route('/')
 def dashboard():
-    return render_template('dashboard.html')
+    return render_template('dashboard.html', intervals=load_intervals(), devices=load_devices())
 
+@app.route('/devices')
+def get_devices():
+    try:
+        return jsonify([{'id': device, 'port': port} for device, port in load_devices()])
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Optional ?since=<timestamp>&after_device=<id> returns only rows after that (timestamp, device) cursor,
+# ?device=<id> one device's rows; responses carry an ETag so unchanged polls get a 304
 @app.route('/data/<interval>')
 def get_data(interval):
-    if interval not in ['interval1', 'interval2', 'interval3']:
+    intervals = {name: seconds for name, seconds, _ in load_intervals()}
+    if interval not in intervals:
         return jsonify({"status": "error", "message": "Invalid interval"}), 400
+    
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = parse_timestamp(since)
+        except ValueError:
+            return jsonify({"status": "error", "message": "since must be formatted as YYYY-MM-DD HH:MM:SS"}), 400
+    after_device = request.args.get('after_device')
+    device = request.args.get('device')
         
     try:
-        with sqlite3.connect('metrics.db') as conn:
-            c = conn.cursor()
-            
-            c.execute('SELECT interval1_seconds, interval2_seconds, interval3_seconds FROM config WHERE id = 1')
-            intervals = c.fetchone()
-            
-            c.execute('''SELECT timestamp, kw_ton, 
-                        ABS(pressure1 - pressure2) as diff_pressure,
-                        ABS(temp1 - temp2) as diff_temp,
-                        cooling_tons,
-                        flow_rate
-                     FROM metrics 
-                     WHERE interval = ? 
-                     ORDER BY timestamp DESC 
-                     LIMIT 500''', (interval,))
-            
-            data = c.fetchall()
+        # Changes whenever a row is aggregated, even for a timestamp already seen, or the interval settings change
+        etag = f'{interval}-{device or "all"}-{recent.latest(interval, device)}-{recent.changes(interval, device)}-' \
+               f'{"-".join(map(str, intervals.values()))}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        # Recent rows come from memory, the database is only read for older history
+        data = recent.rows(interval, since, 500, device, after_device)
+        if data is None:
+            with storage.reader() as conn:
+                c = conn.cursor()
+                
+                device_filter = 'AND device = ?' if device is not None else ''
+                c.execute(f'''SELECT timestamp, kw_ton, 
+                            ABS(pressure1 - pressure2) as diff_pressure,
+                            ABS(temp1 - temp2) as diff_temp,
+                            cooling_tons,
+                            flow_rate,
+                            {''.join(f'{field}, ' for field in PERCENTILE_FIELDS)}
+                            device
+                         FROM metrics 
+                         WHERE interval = ? {device_filter}
+                            AND (timestamp > ? OR (timestamp = ? AND device > ?))
+                         ORDER BY timestamp DESC, device DESC
+                         LIMIT 500''', (interval,) + ((device,) if device is not None else ()) +
+                          (since or 0, since or 0, after_device))
+                
+                data = c.fetchall()
             
         if not data:
-            return jsonify({
+            result = {
                 'timestamps': [],
                 'kw_ton': [],
                 'diff_pressure': [],
                 'diff_temp': [],
                 'cooling_tons': [],
                 'flow_rate': [],
+                'device': [],
                 'intervals': intervals
-            })
+            }
+        else:
+            result = {
+                'timestamps': [format_timestamp(row[0]) for row in data],
+                'kw_ton': [row[1] for row in data],
+                'diff_pressure': [row[2] for row in data],
+                'diff_temp': [row[3] for row in data],
+                'cooling_tons': [row[4] for row in data],
+                'flow_rate': [row[5] for row in data],
+                'device': [row[-1] for row in data],
+                'intervals': intervals
+            }
+        # Percentiles within each bucket, null for rows stored before they were kept
+        for i, field in enumerate(PERCENTILE_FIELDS, start=6):
+            result[field] = [row[i] for row in data]
+        response = jsonify(result)
         
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache' # Browsers revalidate with If-None-Match on every poll
+        return response
+            
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Time range of a request's ?start=&end= ISO dates, end defaults to now and start to default before end.
+# Raises ValueError with the message for the client when either is malformed or the range is empty.
+def request_range(default):
+    try:
+        end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else datetime.now()
+        start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else end - default
+    except ValueError:
+        raise ValueError("start and end must be ISO dates")
+    if start >= end:
+        raise ValueError("start must be before end")
+    return start, end
+
+# Downsampled history for any time range: ?start=&end=&points=&metrics=kw_ton,flow_rate&device=
+@app.route('/history')
+def get_history():
+    try:
+        start, end = request_range(timedelta(days=1))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        points = int(request.args.get('points', 500))
+    except ValueError:
+        return jsonify({"status": "error", "message": "points must be an integer"}), 400
+    if not 1 <= points <= 5000:
+        return jsonify({"status": "error", "message": "points must be between 1 and 5000"}), 400
+    
+    metrics = request.args.get('metrics', ','.join(HISTORY_METRICS)).split(',')
+    if any(metric not in HISTORY_METRICS for metric in metrics):
+        return jsonify({"status": "error", "message": f"metrics must be from {', '.join(HISTORY_METRICS)}"}), 400
+    
+    try:
+        tiers = load_intervals()
+        tiers += [(tier, seconds, ROLLUP_RETENTION_DAYS) for tier, seconds in ROLLUP_TIERS.items()]
+        
+        tier, tier_seconds = choose_tier(tiers, start, end, points)
+        with storage.reader() as conn:
+            result = downsample(conn, tier, start, end, points, metrics, request.args.get('device'))
+        result['tier'] = tier
+        result['tier_seconds'] = tier_seconds
+        return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Percentiles over any time range from the quantile sketches stored with each row, e.g. a month's kW/ton spread:
+# ?interval=&start=&end=&device=&metric=kw_ton&percentiles=5,50,95
+@app.route('/percentiles')
+def get_percentiles():
+    intervals = load_intervals()
+    interval = request.args.get('interval', intervals[-1][0] if intervals else None)
+    if interval not in {name for name, _, _ in intervals}:
+        return jsonify({"status": "error", "message": "Invalid interval"}), 400
+    metric = request.args.get('metric', SKETCH_METRICS[0])
+    if metric not in SKETCH_METRICS:
+        return jsonify({"status": "error", "message": f"metric must be from {', '.join(SKETCH_METRICS)}"}), 400
+    try:
+        start, end = request_range(timedelta(days=30))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        percentiles = [float(p) for p in request.args.get('percentiles', '').split(',') if p] or SKETCH_PERCENTILES
+    except ValueError:
+        return jsonify({"status": "error", "message": "percentiles must be numbers"}), 400
+    if not all(0 <= p <= 100 for p in percentiles):
+        return jsonify({"status": "error", "message": "percentiles must be between 0 and 100"}), 400
+    device = request.args.get('device')
+    
+    try:
+        device_filter = 'AND device = ?' if device is not None else ''
+        with storage.reader() as conn:
+            rows = conn.execute(f'''SELECT {metric}_sketch FROM metrics
+                                WHERE interval = ? {device_filter} AND timestamp > ? AND timestamp <= ?''',
+                                (interval,) + ((device,) if device is not None else ()) +
+                                (int(start.timestamp()), int(end.timestamp()))).fetchall()
+        sketch = merge_stored(blob for blob, in rows)
         return jsonify({
-            'timestamps': [row[0] for row in data],
-            'kw_ton': [row[1] for row in data],
-            'diff_pressure': [row[2] for row in data],
-            'diff_temp': [row[3] for row in data],
-            'cooling_tons': [row[4] for row in data],
-            'flow_rate': [row[5] for row in data],
-            'intervals': intervals
+            'interval': interval,
+            'device': device,
+            'metric': metric,
+            'rows': len(rows),
+            'samples': sketch.count,
+            'min': sketch.min if sketch.count else None,
+            'max': sketch.max if sketch.count else None,
+            'percentiles': {f'p{p:g}': sketch.quantile(p / 100) for p in percentiles},
         })
-            
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Stored rows of one interval as a file download: ?interval=&start=&end=&device=&format=csv|parquet
+@app.route('/export')
+def export():
+    interval = request.args.get('interval')
+    if interval not in {name for name, _, _ in load_intervals()}:
+        return jsonify({"status": "error", "message": "Invalid interval"}), 400
+    file_format = request.args.get('format', 'csv')
+    if file_format not in EXPORT_FORMATS:
+        return jsonify({"status": "error", "message": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    if file_format == 'parquet' and pa is None:
+        return jsonify({"status": "error", "message": "Parquet export needs pyarrow installed"}), 400
+    try:
+        start, end = request_range(timedelta(days=1))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    device = request.args.get('device')
+    if device is not None and device not in {known for known, _ in load_devices()}:
+        return jsonify({"status": "error", "message": "Unknown device"}), 400
+    
+    # Streamed batch by batch from one borrowed reader, nothing is built up in memory
+    def generate():
+        with storage.reader() as conn:
+            batches = export_batches(conn, interval, int(start.timestamp()), int(end.timestamp()), device)
+            yield from (csv_chunks if file_format == 'csv' else parquet_chunks)(batches)
+    
+    filename = f"metrics_{interval}_{device or 'all'}_{start:%Y%m%d%H%M}-{end:%Y%m%d%H%M}.{file_format}"
+    return Response(generate(), mimetype=EXPORT_FORMATS[file_format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# Rolling mean/min/max/p5/p50/p95 of kw_ton, cooling_tons, flow_rate and power over the last 5 minutes,
+# hour, day and week, per device; ?device=<id> for one device. Each window reads one interval's rows.
+@app.route('/summary')
+def get_summary():
+    try:
+        result = summaries.summary(time.time(), request.args.get('device'))
+        for windows in result.values():
+            for entry in windows.values():
+                if entry['newest'] is not None:
+                    entry['newest'] = format_timestamp(entry['newest'])
+        return jsonify({"windows": SUMMARY_WINDOWS, "devices": result})
+    
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# Archived raw samples of one device: ?device=&start=&end=&limit=, started with --raw-archive
+@app.route('/raw')
+def get_raw():
+    devices = [device for device, _ in load_devices()]
+    device = request.args.get('device', devices[0] if len(devices) == 1 else None)
+    if device not in devices:
+        return jsonify({"status": "error", "message": "Unknown or missing device"}), 400
+    try:
+        start, end = request_range(timedelta(hours=1))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        limit = int(request.args.get('limit', MAX_RAW_SAMPLES))
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit must be an integer"}), 400
+    if not 1 <= limit <= MAX_RAW_SAMPLES:
+        return jsonify({"status": "error", "message": f"limit must be between 1 and {MAX_RAW_SAMPLES}"}), 400
+    
+    try:
+        if RAW_ARCHIVE:
+            columns = archive_for(device).read(start.timestamp(), end.timestamp(), limit)
+        elif device in aggregators:
+            # Without the archive only the samples still in memory are known
+            with aggregators[device].lock:
+                columns = aggregators[device].samples.window(start.timestamp(), end.timestamp(), limit)
+        else:
+            return jsonify({"status": "error", "message": "No samples collected for this device"}), 404
+        result = {'device': device, 'timestamp': [format_timestamp(t) for t in columns['timestamp']]}
+        for field in RAW_FIELDS:
+            result[field] = columns[field].tolist()
+        return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Per-route latency, labelled with the route pattern so /data/<interval> is one series
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_started,
+                            route=route, method=request.method, status=response.status_code)
+    return response
+
+# Counters and histograms of the logger itself in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Sampled stacks of every thread in collapsed flame graph format, ?format=json for the profiler state.
+# POST {"enabled": true|false, "interval": seconds, "reset": true} switches the profiler.
+@app.route('/profile', methods=['GET', 'POST'])
+def profile():
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"status": "error", "message": "Expected a JSON object"}), 400
+        try:
+            interval = float(data['interval']) if 'interval' in data else None
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "interval must be a number"}), 400
+        if interval is not None and not MIN_PROFILE_INTERVAL <= interval <= MAX_PROFILE_INTERVAL:
+            return jsonify({"status": "error", "message":
+                            f"interval must be between {MIN_PROFILE_INTERVAL} and {MAX_PROFILE_INTERVAL} seconds"}), 400
+        if data.get('reset'):
+            profiler.reset()
+        if data.get('enabled') is True:
+            profiler.start(interval)
+        elif data.get('enabled') is False:
+            profiler.stop()
+        elif interval is not None:
+            profiler.interval = interval
+        return jsonify(dict(profiler.summary(), status="success"))
+    if request.args.get('format') == 'json':
+        return jsonify(profiler.summary())
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+# Interval and device filters of a /stream request, raises ValueError for an unknown interval
+def stream_filter(args):
+    interval = args.get('interval')
+    if interval is not None and interval not in {name for name, _, _ in load_intervals()}:
+        raise ValueError("Invalid interval")
+    return interval, args.get('device')
+
+# Live updates as Server-Sent Events: 'aggregate' for new rows of the chosen interval, 'sample' for raw readings.
+# Optional ?device=<id> limits both to one device.
+@app.route('/stream')
+def stream():
+    try:
+        interval, device = stream_filter(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    def events():
+        subscription = broadcaster.subscribe([interval] if interval else None, device)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    yield subscription.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n' # Keeps proxies from closing an idle connection
+        finally:
+            broadcaster.unsubscribe(subscription)
+    
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# /stream for the asyncio runtime, served on the event loop so idle clients cost no thread
+async def stream_async(request, reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        interval, device = await loop.run_in_executor(None, stream_filter, request.args)
+    except ValueError as e:
+        await send_json(writer, 400, {"status": "error", "message": str(e)})
+        return
+    
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                 b'X-Accel-Buffering: no\r\nConnection: close\r\n\r\nretry: 5000\n\n')
+    subscription = broadcaster.subscribe([interval] if interval else None, device, asynchronous=True)
+    disconnected = asyncio.ensure_future(reader.read()) # Clients send nothing more, this completes when they leave
+    try:
+        while not disconnected.done():
+            await writer.drain()
+            message = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait({message, disconnected}, timeout=15,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if message in done:
+                writer.write(message.result().encode())
+            else:
+                message.cancel()
+                if not disconnected.done():
+                    writer.write(b': keepalive\n\n') # Keeps proxies from closing an idle connection
+    finally:
+        disconnected.cancel()
+        broadcaster.unsubscribe(subscription)
+
+VACUUM_PAGES_PER_STEP = 256
+VACUUM_STEP_PAUSE = 0.5  # seconds between incremental vacuum steps
+CLEANUP_PERIOD = 3600  # seconds
+
+# Drop expired data and return the freed space, one pass
+@CLEANUP_SECONDS.time()
+def cleanup_once():
+    intervals = load_intervals()
+    
+    if not intervals:
+        return
+    
+    current_time = int(time.time())
+    
+    cutoffs = {}
+    for interval_name, _, retention_days in intervals:
+        cutoffs[interval_name] = current_time - retention_days * 24 * 3600
+    # Intervals removed from the configuration lose all their partitions
+    for (interval_name,) in storage.query('SELECT DISTINCT interval FROM partitions'):
+        cutoffs.setdefault(interval_name, sys.maxsize)
+    
+    # Expired data is dropped a whole partition at a time, no row-by-row DELETE
+    storage.drop_expired(cutoffs)
+    
+    rollup_cutoff = current_time - ROLLUP_RETENTION_DAYS * 24 * 3600
+    storage.execute('DELETE FROM rollups WHERE timestamp < ?', (rollup_cutoff,))
+    
+    # Raw samples expire a whole segment file at a time
+    for device, _ in load_devices():
+        archive_for(device).drop_expired(current_time - RAW_RETENTION_DAYS * 24 * 3600)
+    
+    # Hand freed pages back in small steps so collector writes never wait long
+    free_pages = storage.incremental_vacuum(VACUUM_PAGES_PER_STEP)
+    while free_pages > 0:
+        time.sleep(VACUUM_STEP_PAUSE)
+        remaining = storage.incremental_vacuum(VACUUM_PAGES_PER_STEP)
+        if remaining >= free_pages:
+            break
+        free_pages = remaining
+
 def cleanup_old_data():
     while True:
         try:
-            with sqlite3.connect('metrics.db') as conn:
-                c = conn.cursor()
-                
-                c.execute('''SELECT retention_interval1, retention_interval2, retention_interval3 
-                           FROM config WHERE id = 1''')
-                retention_settings = c.fetchone()
-                
-                if not retention_settings:
-                    time.sleep(3600)
-                    continue
-                
-                current_time = datetime.now()
-                
-                for interval_num, retention_days in enumerate(retention_settings, 1):
-                    cutoff_date = current_time - timedelta(days=retention_days)
-                    cutoff_str = cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
-                    
-                    c.execute('''DELETE FROM metrics 
-                               WHERE interval = ? AND timestamp < ?''', 
-                            (f'interval{interval_num}', cutoff_str))
-                
-                conn.commit()
-                
-        except Exception:
-            pass
+            cleanup_once()
+        except Exception as e:
+            print(f"Cleanup failed: {e!r}")
+            CLEANUP_ERRORS.inc()
         
-        time.sleep(3600)
+        time.sleep(CLEANUP_PERIOD)
+
+# Periodic jobs of the asyncio runtime. Their SQLite work runs in the executor, the loop only schedules it.
+async def flush_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(storage.flush_interval)
+        await loop.run_in_executor(None, storage.flush)
+
+async def cleanup_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, cleanup_once)
+        except Exception as e:
+            print(f"Cleanup failed: {e!r}")
+            CLEANUP_ERRORS.inc()
+        await asyncio.sleep(CLEANUP_PERIOD)
+
+# Collectors, flushes, retention and HTTP on one event loop; Flask views run in the default executor
+async def run_async(ports, host, port):
+    server = HTTPServer(app, {'/stream': stream_async})
+    await asyncio.gather(server.serve(host, port),
+                         flush_periodically(),
+                         cleanup_periodically(),
+                         *(collect_data_async(device_port) for device_port in ports))
+
+# Threads by default; start with --asyncio to run everything on one event loop (POSIX serial ports only)
+ASYNC_RUNTIME = '--asyncio' in sys.argv
+# --sensor=<port or spec> (repeatable) replaces board detection, e.g. --sensor=sim:bench?rate=50 (see sources.py)
+SENSOR_ARGS = [arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--sensor=')]
+PROFILE_AT_START = '--profile' in sys.argv  # Sample stacks from startup on, read them from /profile
 
 if __name__ == '__main__':
     init_db()
-    data_thread = Thread(target=collect_data, daemon=True)
-    cleanup_thread = Thread(target=cleanup_old_data, daemon=True)
+    storage = Storage(DB_PATH)
+    with storage.transaction() as c:
+        rollup_interval = update_rollup_source(c)
+    refresh_recent()
+    recomputer = Recomputer(storage, on_finished=refresh_recent, open_until=open_buckets_end,
+                            archive_for=archive_for if RAW_ARCHIVE else None)
+    recomputer.start()  # Continues a job cut short by the last shutdown
+    if PROFILE_AT_START:
+        profiler.start()
     
-    data_thread.start()
-    cleanup_thread.start()
+    # Every detected board or given sensor gets its own collector, all sharing one database
+    ports = SENSOR_ARGS or Sensor.find_arduino_ports() or [DEFAULT_PORT]
+    for port in ports:
+        make_source(port)  # A bad simulator or replay spec fails here rather than in a retrying collector
     
-    app.run(host='0.0.0.0', port=5001, debug=False)
\ No newline at end of file
+    if ASYNC_RUNTIME:
+        try:
+            asyncio.run(run_async(ports, '0.0.0.0', 5001))
+        except KeyboardInterrupt:
+            pass
+    else:
+        storage.start()
+        data_threads = [Thread(target=collect_data, args=(port,), daemon=True) for port in ports]
+        cleanup_thread = Thread(target=cleanup_old_data, daemon=True)
+        
+        for data_thread in data_threads:
+            data_thread.start()
+        cleanup_thread.start()
+        
+        app.run(host='0.0.0.0', port=5001, debug=False)
+    storage.close()  # Write out any queued aggregates
+    for archive in archives.values():
+        if archive is not None:
+            archive.close()
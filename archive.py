@@ -0,0 +1,166 @@
+import mmap
+import os
+import struct
+import threading
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Raw sensor readings as the Sensor hands them over, in record order
+RAW_FIELDS = ('temp1', 'temp2', 'pressure1', 'pressure2', 'power')
+
+# Segment file: header, then fixed-size records in arrival order.
+# Records are float64 epoch timestamp + float32 readings, the precision the firmware sends.
+SEGMENT_MAGIC = b'RAWS'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct('<4sHHd')  # magic, version, record size, segment start
+RECORD = struct.Struct('<d5f')
+SEGMENT_SUFFIX = '.seg'
+
+class SampleArchive:
+    def __init__(self, path: str, segment_seconds: int = 3600, buffer_records: int = 256):
+        """Append-only archive of one device's raw samples, one file per segment_seconds of data.
+
+        Segment files are named after the epoch start of the period they cover,
+        which is the archive's time index. Records within a segment are in
+        timestamp order, so reads memory-map the file and binary search it
+        instead of keeping a per-record index. Appends are buffered and
+        written buffer_records at a time; a record cut short by a crash is
+        dropped when the segment is next opened.
+        """
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.buffer_records = buffer_records
+        self._buffer = bytearray()
+        self._buffered = 0
+        self._file = None
+        self._segment_start = None
+        self._last_timestamp = None
+        self._lock = threading.Lock()
+
+    def _segment_path(self, start: int) -> str:
+        return os.path.join(self.path, f'{start}{SEGMENT_SUFFIX}')
+
+    def segments(self) -> List[int]:
+        """Start times of the stored segments, oldest first"""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in names
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def append(self, timestamp: float, values: Sequence[float]) -> None:
+        """Archive one sample, timestamps of a device must not go backwards"""
+        with self._lock:
+            if self._last_timestamp is not None and timestamp < self._last_timestamp:
+                return  # Would break the sorted order reads rely on
+            start = int(timestamp - timestamp % self.segment_seconds)
+            if start != self._segment_start:
+                self._flush()
+                self._open(start)
+            self._buffer += RECORD.pack(timestamp, *values)
+            self._buffered += 1
+            self._last_timestamp = timestamp
+            if self._buffered >= self.buffer_records:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._segment_start = None
+
+    def _flush(self) -> None:
+        if self._buffer and self._file is not None:
+            self._file.write(self._buffer)
+            self._file.flush()
+        self._buffer.clear()
+        self._buffered = 0
+
+    def _open(self, start: int) -> None:
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.path, exist_ok=True)
+        path = self._segment_path(start)
+        self._file = open(path, 'a+b')
+        size = self._file.seek(0, os.SEEK_END)
+        if size < SEGMENT_HEADER.size:
+            self._file.truncate(0)
+            self._file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, RECORD.size, start))
+        else:
+            # Drop a partial record left by a crash, later appends stay aligned
+            whole = SEGMENT_HEADER.size + (size - SEGMENT_HEADER.size) // RECORD.size * RECORD.size
+            if whole != size:
+                self._file.truncate(whole)
+            if whole > SEGMENT_HEADER.size:
+                self._file.seek(whole - RECORD.size)
+                (last,) = struct.unpack_from('<d', self._file.read(RECORD.size))
+                self._last_timestamp = last if self._last_timestamp is None else max(self._last_timestamp, last)
+            self._file.seek(0, os.SEEK_END)
+        self._segment_start = start
+
+    def read(self, start: float, end: float, limit: Optional[int] = None) -> Dict[str, array]:
+        """Columns of the archived samples with start <= timestamp < end, oldest first"""
+        self.flush()  # Buffered samples are part of the answer
+        result = {'timestamp': array('d')}
+        for field in RAW_FIELDS:
+            result[field] = array('d')
+        for segment in self.segments():
+            if segment + self.segment_seconds <= start or segment >= end:
+                continue
+            for record in self._read_segment(segment, start, end):
+                if limit is not None and len(result['timestamp']) >= limit:
+                    return result
+                result['timestamp'].append(record[0])
+                for field, value in zip(RAW_FIELDS, record[1:]):
+                    result[field].append(value)
+        return result
+
+    def _read_segment(self, segment: int, start: float, end: float) -> List[Tuple[float, ...]]:
+        try:
+            with open(self._segment_path(segment), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                count = (size - SEGMENT_HEADER.size) // RECORD.size
+                if count <= 0:
+                    return []
+                with mmap.mmap(f.fileno(), SEGMENT_HEADER.size + count * RECORD.size,
+                               access=mmap.ACCESS_READ) as view:
+                    magic, version, record_size, _ = SEGMENT_HEADER.unpack_from(view, 0)
+                    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or record_size != RECORD.size:
+                        return []
+                    first = self._bisect(view, count, start)
+                    last = self._bisect(view, count, end)
+                    offset = SEGMENT_HEADER.size
+                    return list(RECORD.iter_unpack(view[offset + first * RECORD.size:offset + last * RECORD.size]))
+        except FileNotFoundError:
+            return []  # Dropped by retention meanwhile
+
+    # First record whose timestamp is >= value
+    @staticmethod
+    def _bisect(view: mmap.mmap, count: int, value: float) -> int:
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (timestamp,) = struct.unpack_from('<d', view, SEGMENT_HEADER.size + mid * RECORD.size)
+            if timestamp < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def drop_expired(self, cutoff: float) -> int:
+        """Delete every segment whose samples are all older than cutoff, returns the number deleted"""
+        dropped = 0
+        with self._lock:
+            for segment in self.segments():
+                if segment + self.segment_seconds > cutoff or segment == self._segment_start:
+                    continue
+                os.remove(self._segment_path(segment))
+                dropped += 1
+        return dropped
@@ -0,0 +1,264 @@
+"""Benchmarks of the ingest, aggregation, storage and query paths on synthetic data.
+
+    python benchmark.py --devices 4 --rate 10 --seconds 3600 --retention-days 30 --output results.json
+    python benchmark.py --baseline results.json   # Compare against an earlier run
+
+Each stage reports throughput, per-operation p50/p99 latency and the process's
+peak RSS. --trace-memory adds the stage's peak Python allocations, at the cost
+of slower timings. Everything runs against a temporary database.
+"""
+import argparse
+import binascii
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+STAGES = ('parse_text', 'parse_binary', 'aggregate', 'prefill', 'store', 'query')
+FEED_CHUNK = 32  # Lines or frames handed to the decoder per serial read
+STORE_BATCH = 50  # Rows per flush, the storage default flush size
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+def max_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage  # Bytes on macOS, KiB elsewhere
+
+class Stage:
+    """Times the operations of one stage, items counts samples or rows for the throughput"""
+
+    def __init__(self, name, trace_memory):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.latencies = []
+        self.items = 0
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def time(self, operation, *args, items=1):
+        started = time.perf_counter()
+        result = operation(*args)
+        self.latencies.append(time.perf_counter() - started)
+        self.items += items
+        return result
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
+        self.peak_traced = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def result(self):
+        # Throughput counts only the timed operations, not generating their input
+        busy = sum(self.latencies)
+        return {
+            'items': self.items,
+            'operations': len(self.latencies),
+            'seconds': self.elapsed,
+            'busy_seconds': busy,
+            'items_per_second': self.items / busy if busy else None,
+            'p50_ms': percentile(self.latencies, 0.5) * 1000 if self.latencies else None,
+            'p99_ms': percentile(self.latencies, 0.99) * 1000 if self.latencies else None,
+            'peak_traced_kb': self.peak_traced // 1024 if self.peak_traced is not None else None,
+            'max_rss_kb': max_rss_kb(),
+        }
+
+def bench_parse_text(args, stage):
+    from sources import SimulatedSource, SourceSensor
+    sensor = SourceSensor(SimulatedSource(rate=args.rate, seed=1), 'sim:bench')
+    sensor._running.set()  # Fed by hand below, no source thread
+    lines = iter(SimulatedSource(rate=args.rate, noise=0.01, malformed=0.001, seed=1))
+    total = args.samples
+    while total > 0:
+        chunk = b''.join(next(lines)[1] for _ in range(min(FEED_CHUNK, total)))
+        stage.time(sensor._feed, chunk, time.time(), items=min(FEED_CHUNK, total))
+        total -= FEED_CHUNK
+        while sensor.get(timeout=0) is not None:
+            pass
+
+def bench_parse_binary(args, stage):
+    from Sensor import FRAME_BODY, FRAME_CRC, FRAME_SYNC
+    from sources import SimulatedSource, SourceSensor
+    sensor = SourceSensor(SimulatedSource(), 'sim:bench')
+    sensor.binary = True
+    sensor._running.set()
+    frames = []
+    for seq in range(FEED_CHUNK * 64):
+        body = FRAME_BODY.pack(seq & 0xFFFF, 12.0, 7.0, 3.2, 2.9, 50.0 + seq % 7)
+        frames.append(FRAME_SYNC + body + FRAME_CRC.pack(binascii.crc_hqx(body, 0xFFFF)))
+    chunks = [b''.join(frames[i:i + FEED_CHUNK]) for i in range(0, len(frames), FEED_CHUNK)]
+    total = args.samples
+    while total > 0:
+        for chunk in chunks:
+            stage.time(sensor._feed, chunk, time.time(), items=FEED_CHUNK)
+            while sensor.get(timeout=0) is not None:
+                pass
+        total -= len(frames)
+
+def bench_aggregate(args, stage, app):
+    # Samples span the simulated period right up to now, spread over the devices
+    start = time.time() - args.seconds
+    aggregators = [app.DataAggregator(1, app.storage) for _ in range(args.devices)]
+    step = 1 / args.rate
+    rows = 0
+    for i in range(int(args.seconds * args.rate)):
+        epoch = start + i * step
+        for n, aggregator in enumerate(aggregators):
+            stage.time(aggregator.add_data_point, 12.0 + n * 0.01, 7.0, 3.2 + (i % 10) * 0.01, 2.9, 50.0, epoch)
+            rows += len(aggregator.close_due(epoch))
+    return {'rows_closed': rows}
+
+def sketch_values():
+    # Percentiles and sketch of a minute of 1 Hz samples, the size stored with a typical row
+    from sketch import SKETCH_METRICS, QuantileSketch, sketch_columns
+    sketches = {metric: QuantileSketch() for metric in SKETCH_METRICS}
+    for i in range(60):
+        for sketch in sketches.values():
+            sketch.add(0.8 + (i % 10) * 0.005)
+    return sketch_columns(sketches)
+
+def bench_prefill(args, stage, app):
+    # Retention's worth of history for every device and interval, written the way the collector does
+    now = int(time.time())
+    intervals = app.load_intervals()
+    sketches = sketch_values()
+    batch = 0
+    for name, seconds, _ in intervals:
+        for n in range(args.devices):
+            for timestamp in range(now - args.retention_days * 86400, now, seconds):
+                app.storage.insert_metrics((timestamp - timestamp % seconds, 12.0, 7.0, 3.2, 2.9, 50.0,
+                                            0.8, 62.0, 30.0, *sketches, f'bench{n}', name))
+                batch += 1
+                if batch == 5000:
+                    stage.time(app.storage.flush, items=batch)
+                    batch = 0
+    if batch:
+        stage.time(app.storage.flush, items=batch)
+    app.refresh_recent()
+
+def bench_store(args, stage, app):
+    # Live-sized batches on top of the prefilled history, newest interval only
+    name, seconds, _ = app.load_intervals()[0]
+    sketches = sketch_values()
+    timestamp = int(time.time()) - int(time.time()) % seconds + seconds
+    for _ in range(max(1, args.samples // STORE_BATCH)):
+        for _ in range(STORE_BATCH):
+            timestamp += seconds
+            app.storage.insert_metrics((timestamp, 12.0, 7.0, 3.2, 2.9, 50.0, 0.8, 62.0, 30.0, *sketches,
+                                        'bench0', name))
+        stage.time(app.storage.flush, items=STORE_BATCH)
+
+def bench_query(args, stage, app):
+    client = app.app.test_client()
+    intervals = [name for name, _, _ in app.load_intervals()]
+    end = datetime.now()
+    start = end - timedelta(days=args.retention_days)
+    paths = [f'/data/{intervals[0]}',
+             f'/data/{intervals[0]}?device=bench0',
+             f'/data/{intervals[-1]}?since=0',
+             f'/history?start={start.isoformat()}&end={end.isoformat()}&points=500',
+             f'/history?start={start.isoformat()}&end={end.isoformat()}&points=500&device=bench0']
+    per_path = {}
+    for path in paths:
+        latencies = len(stage.latencies)
+        for _ in range(args.requests):
+            response = stage.time(client.get, path)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path} answered {response.status_code}')
+        per_path[path] = {
+            'p50_ms': percentile(stage.latencies[latencies:], 0.5) * 1000,
+            'p99_ms': percentile(stage.latencies[latencies:], 0.99) * 1000,
+        }
+    return {'paths': per_path}
+
+def setup_database(args, directory):
+    os.chdir(directory)  # app.py keeps its database in the working directory
+    import app
+    app.init_db()
+    conn = sqlite3.connect(app.DB_PATH)
+    conn.execute('UPDATE intervals SET retention_days = ?', (args.retention_days,))
+    conn.commit()
+    conn.close()
+    app.storage = app.Storage(app.DB_PATH)
+    return app
+
+def compare(results, baseline):
+    print(f"\n{'stage':<14}{'items/s':>14}{'baseline':>14}{'change':>10}")
+    for name, result in results['stages'].items():
+        before = baseline.get('stages', {}).get(name, {}).get('items_per_second')
+        now = result['items_per_second']
+        change = f'{(now / before - 1) * 100:+.1f}%' if before and now else ''
+        print(f"{name:<14}{now or 0:>14.0f}{before or 0:>14.0f}{change:>10}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated, from ' + ', '.join(STAGES))
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=1.0, help='samples per second per device')
+    parser.add_argument('--seconds', type=int, default=3600, help='simulated collection time for aggregate')
+    parser.add_argument('--samples', type=int, default=100000, help='samples for the parse and store stages')
+    parser.add_argument('--retention-days', type=int, default=7, help='history stored before query runs')
+    parser.add_argument('--requests', type=int, default=50, help='requests per query path')
+    parser.add_argument('--trace-memory', action='store_true')
+    parser.add_argument('--output', default=f'benchmark-{datetime.now():%Y%m%d-%H%M%S}.json')
+    parser.add_argument('--baseline', help='earlier results to compare with')
+    args = parser.parse_args(argv)
+    stages = args.stages.split(',')
+    if any(name not in STAGES for name in stages):
+        parser.error('stages must be from ' + ', '.join(STAGES))
+    if 'query' in stages and 'prefill' not in stages:
+        stages.insert(stages.index('query'), 'prefill')  # Queries need stored history
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    cwd = os.getcwd()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    results = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'config': {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')},
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(),
+                     'system': platform.platform(), 'sqlite': sqlite3.sqlite_version},
+        'stages': {},
+    }
+    try:
+        app = setup_database(args, directory) if set(stages) & {'aggregate', 'prefill', 'store', 'query'} else None
+        for name in stages:
+            bench = globals()[f'bench_{name}']
+            with Stage(name, args.trace_memory) as stage:
+                extra = bench(args, stage) if app is None or name.startswith('parse') else bench(args, stage, app)
+            results['stages'][name] = dict(stage.result(), **(extra or {}))
+            result = results['stages'][name]
+            print(f"{name:<14}{result['items_per_second'] or 0:>12.0f}/s  p50 {result['p50_ms'] or 0:8.3f} ms  "
+                  f"p99 {result['p99_ms'] or 0:8.3f} ms  rss {result['max_rss_kb']} KiB")
+        if app is not None:
+            app.storage.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+    if baseline is not None:
+        compare(results, baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import threading
+from collections import deque
+from typing import Iterable, List, Optional
+
+from sketch import SKETCH_METRICS, SKETCH_PERCENTILES
+
+# Percentile columns of the metrics rows, <metric>_p<n>
+PERCENTILE_FIELDS = tuple(f'{metric}_p{p}' for metric in SKETCH_METRICS for p in SKETCH_PERCENTILES)
+# Fields of a cached row, the same columns /data/<interval> returns
+ROW_FIELDS = ('timestamp', 'kw_ton', 'diff_pressure', 'diff_temp', 'cooling_tons', 'flow_rate') + \
+             PERCENTILE_FIELDS + ('device',)
+
+class RecentCache:
+    def __init__(self, size: int = 500):
+        """Newest aggregated rows per interval, so the dashboard rarely touches SQLite.
+
+        The collector adds rows as it produces them. Rows are tuples in
+        ROW_FIELDS order and kept oldest first, once per (interval, device)
+        and once per (interval, None) for queries across all devices.
+        Devices share timestamps, so rows are ordered by (timestamp, device).
+        """
+        self.size = size
+        self._rows = {}
+        self._complete = {}  # (interval, device) -> True when the cache holds every stored row
+        self._changes = {}  # (interval, device) -> rows added or reloads so far
+        self._lock = threading.Lock()
+
+    def warm(self, storage, intervals: Iterable[str], devices: Iterable[str]) -> None:
+        """Load the newest rows of each interval, per device and across devices, from the database.
+
+        Safe while the collector adds rows, so it also refreshes the cache after stored rows changed.
+        """
+        devices = list(devices)
+        for interval in intervals:
+            for device in [None] + devices:
+                device_filter = 'AND device = ?' if device is not None else ''
+                params = (interval, device) if device is not None else (interval,)
+                rows = storage.query(f'''SELECT timestamp, kw_ton,
+                                        ABS(pressure1 - pressure2),
+                                        ABS(temp1 - temp2),
+                                        cooling_tons,
+                                        flow_rate,
+                                        {''.join(f'{field}, ' for field in PERCENTILE_FIELDS)}
+                                        device
+                                     FROM metrics
+                                     WHERE interval = ? {device_filter}
+                                     ORDER BY timestamp DESC, device DESC
+                                     LIMIT ?''', params + (self.size,))
+                with self._lock:
+                    # Rows added while the query ran are newer than anything it returned
+                    newest = rows[0][0] if rows else None
+                    added = [row for row in self._rows.get((interval, device), ())
+                             if newest is None or row[0] > newest]
+                    self._rows[interval, device] = deque(reversed(rows), maxlen=self.size)
+                    self._rows[interval, device].extend(added)
+                    self._complete[interval, device] = len(rows) < self.size
+                    self._changes[interval, device] = self._changes.get((interval, device), 0) + 1
+
+    def add(self, interval: str, row: tuple) -> None:
+        with self._lock:
+            for key in ((interval, row[-1]), (interval, None)):
+                if key not in self._rows:
+                    self._rows[key] = deque(maxlen=self.size)
+                    self._complete[key] = False
+                self._rows[key].append(row)
+                self._changes[key] = self._changes.get(key, 0) + 1
+
+    def latest(self, interval: str, device: Optional[str] = None) -> Optional[int]:
+        """Timestamp of the newest cached row"""
+        with self._lock:
+            rows = self._rows.get((interval, device))
+            return rows[-1][0] if rows else None
+
+    def changes(self, interval: str, device: Optional[str] = None) -> int:
+        """Rows added and reloads so far, grows with every change of the cached rows"""
+        with self._lock:
+            return self._changes.get((interval, device), 0)
+
+    def rows(self, interval: str, since: Optional[int] = None, limit: int = 500,
+             device: Optional[str] = None, after_device: Optional[str] = None) -> Optional[List[tuple]]:
+        """Newest rows first after the (since, after_device) cursor, or None if the answer needs older history.
+
+        Without after_device every row at since counts as seen.
+        """
+        with self._lock:
+            rows = self._rows.get((interval, device))
+            if rows is None:
+                return None
+            complete = self._complete[interval, device]
+            if not complete:
+                if since is None and limit > len(rows):
+                    return None
+                if since is not None and (not rows or since < rows[0][0] or
+                                          (after_device is not None and since == rows[0][0])):
+                    return None
+            result = []
+            for row in reversed(rows):
+                if since is not None and row[0] < since:
+                    break
+                # Rows of one timestamp arrive in any device order, so all of them are checked
+                if since is None or row[0] > since or (after_device is not None and row[-1] > after_device):
+                    result.append(row)
+            result.sort(key=lambda row: (row[0], row[-1]), reverse=True)
+            return result[:limit]
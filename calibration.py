@@ -0,0 +1,87 @@
+import math
+from typing import Iterable, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # Optional, only speeds up calculate_flow_rates
+    np = None
+
+# Used until at least two calibration points with different pressures exist
+DEFAULT_SLOPE = 0.5
+DEFAULT_COEFFICIENT = 1.0
+
+def fit_power_law(points: Iterable[Tuple[float, float]]) -> Optional[Tuple[float, float]]:
+    """Least-squares fit of flow = a * dp ** m in log space, returns (a, m) or None.
+
+    Points with a non-positive pressure difference or flow rate are ignored.
+    """
+    logs = [(math.log(x), math.log(y)) for x, y in points if x > 0 and y > 0]
+    if len(logs) < 2:
+        return None
+    mean_x = sum(x for x, _ in logs) / len(logs)
+    mean_y = sum(y for _, y in logs) / len(logs)
+    sxx = sum((x - mean_x) ** 2 for x, _ in logs)
+    if sxx == 0:
+        return None  # All at one pressure, the slope is undefined
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in logs)
+    m = sxy / sxx
+    b = mean_y - m * mean_x
+    return math.exp(b), m
+
+class FlowCalibration:
+    def __init__(self, storage, window: Optional[int] = None):
+        """Power-law flow calibration fitted over the stored calibration points.
+
+        window limits the fit to the newest points, None uses all of them.
+        Coefficients are kept as one (a, m) tuple so readers never see a
+        half-updated pair while reload() runs on another thread.
+        """
+        self.storage = storage
+        self.window = window
+        self.coefficients = (DEFAULT_COEFFICIENT, DEFAULT_SLOPE)
+        self.num_points = 0
+        self.reload()
+
+    @property
+    def a(self) -> float:
+        return self.coefficients[0]
+
+    @property
+    def m(self) -> float:
+        return self.coefficients[1]
+
+    @property
+    def b(self) -> float:
+        """Intercept in log space, log(a)"""
+        return math.log(self.a)
+
+    def reload(self) -> None:
+        """Refit from the database, called at startup and whenever a point is added"""
+        points = self.storage.query('''SELECT pressure_diff, flow_rate
+                                    FROM calibration_points
+                                    ORDER BY timestamp DESC, id DESC
+                                    LIMIT ?''', (self.window if self.window is not None else -1,))
+        fit = fit_power_law(points)
+        if fit is not None:
+            self.coefficients = fit
+            self.num_points = len(points)
+
+    def calculate_flow_rate(self, pressure_diff: float) -> float:
+        if pressure_diff <= 0:
+            return 0
+        a, m = self.coefficients
+        return a * (pressure_diff ** m)
+
+    def calculate_flow_rates(self, pressure_diffs: Sequence[float]):
+        """Flow rate for many pressure differences at once.
+
+        Returns a NumPy array when NumPy is installed, otherwise a list.
+        """
+        a, m = self.coefficients
+        if np is not None:
+            dp = np.asarray(pressure_diffs, dtype=float)
+            result = np.zeros_like(dp)
+            np.power(dp, m, out=result, where=dp > 0)
+            result *= a
+            return result
+        return [a * (dp ** m) if dp > 0 else 0.0 for dp in pressure_diffs]
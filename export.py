@@ -0,0 +1,100 @@
+import csv
+import io
+import sqlite3
+from typing import Iterator, List, Optional
+
+from cache import PERCENTILE_FIELDS
+from storage import format_timestamp
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional, only needed for Parquet exports
+    pa = None
+
+# Columns of an exported row, in file order
+EXPORT_COLUMNS = ('timestamp', 'device', 'interval', 'temp1', 'temp2', 'pressure1', 'pressure2',
+                  'power', 'kw_ton', 'cooling_tons', 'flow_rate') + PERCENTILE_FIELDS
+EXPORT_BATCH = 5000  # Rows fetched, converted and sent at a time
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+def export_batches(conn: sqlite3.Connection, interval: str, start: int, end: int,
+                   device: Optional[str] = None, batch: int = EXPORT_BATCH) -> Iterator[List[tuple]]:
+    """Rows of one interval with start <= timestamp < end in EXPORT_COLUMNS order, batch rows at a time.
+
+    Partitions are read one after another in time order with fetchmany, so
+    only one batch is held in memory whatever the length of the range.
+    """
+    partitions = conn.execute('''SELECT name FROM partitions
+                              WHERE interval = ? AND end_time > ? AND start_time < ?
+                              ORDER BY start_time''', (interval, start, end)).fetchall()
+    device_filter = 'AND device = ?' if device is not None else ''
+    params = (interval,) + ((device,) if device is not None else ()) + (start, end)
+    for (name,) in partitions:
+        try:
+            cursor = conn.execute(f'''SELECT {', '.join(EXPORT_COLUMNS)} FROM {name}
+                                  WHERE interval = ? {device_filter} AND timestamp >= ? AND timestamp < ?
+                                  ORDER BY timestamp, device''', params)
+        except sqlite3.OperationalError:
+            continue  # Dropped by retention since the list was read
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            yield rows
+
+def csv_chunks(batches: Iterator[List[tuple]]) -> Iterator[str]:
+    """CSV text with a header line, one chunk per batch, timestamps as local time strings"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows((format_timestamp(row[0]),) + row[1:] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that keeps what the Parquet writer wrote until it is taken"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def parquet_chunks(batches: Iterator[List[tuple]]) -> Iterator[bytes]:
+    """Parquet file, one row group per batch, sent as soon as each group is written. Needs pyarrow."""
+    schema = pa.schema([('timestamp', pa.timestamp('s', tz='UTC')), ('device', pa.string()),
+                        ('interval', pa.string())] +
+                       [(column, pa.float64()) for column in EXPORT_COLUMNS[3:]])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
@@ -0,0 +1,199 @@
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from storage import format_timestamp
+
+# Series available from /history, as SQL expressions over a metrics row
+HISTORY_METRICS = {
+    'kw_ton': 'kw_ton',
+    'diff_pressure': 'ABS(pressure1 - pressure2)',
+    'diff_temp': 'ABS(temp1 - temp2)',
+    'cooling_tons': 'cooling_tons',
+    'flow_rate': 'flow_rate',
+}
+
+# Precomputed tiers coarser than the configured intervals, rolled up from one interval (choose_rollup_source)
+ROLLUP_TIERS = {'day': 86400}
+ROLLUP_RETENTION_DAYS = 3650
+LEGACY_ROLLUP_SOURCE = 'interval3'  # Fed the rollups before intervals could be renamed
+WALL_CLOCK_EPOCH = datetime(1970, 1, 1)
+
+# Sum, min and max of every history metric over a group of metrics rows, in rollup column order
+ROLLUP_SELECTS = ', '.join(f'SUM({expr}), MIN({expr}), MAX({expr})' for expr in HISTORY_METRICS.values())
+
+# A tier is used when the range holds at most this many of its rows per requested point
+ROWS_PER_POINT = 4
+
+def init_rollups(c, source: str, device: str = 'device') -> None:
+    """Create the rollup table and fill it from existing rows of the source interval.
+
+    device is the SQL expression giving the device of a metrics row, for
+    migrations that run before metrics had a device column.
+    """
+    columns = ',\n'.join(f'{name}_sum REAL NOT NULL, {name}_min REAL NOT NULL, {name}_max REAL NOT NULL'
+                         for name in HISTORY_METRICS)
+    c.execute(f'''CREATE TABLE IF NOT EXISTS rollups
+    (tier TEXT NOT NULL,
+    device TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    {columns},
+    num_rows INTEGER NOT NULL,
+    PRIMARY KEY (tier, device, timestamp)) WITHOUT ROWID''')
+
+    c.execute('SELECT COUNT(*) FROM rollups')
+    if c.fetchone()[0]:
+        return
+    for tier, seconds in ROLLUP_TIERS.items():
+        bucket = rollup_bucket_sql(seconds)
+        c.execute(f'''INSERT INTO rollups
+                   SELECT ?, {device}, {bucket}, {ROLLUP_SELECTS}, COUNT(*)
+                   FROM metrics WHERE interval = ?
+                   GROUP BY {device}, {bucket}''', (tier, source))
+
+def choose_rollup_source(intervals: Iterable[Sequence]) -> Optional[str]:
+    """Slowest interval shorter than the tiers that divides each of them, else the slowest shorter one.
+
+    intervals are (name, seconds, ...) rows, None when no interval is shorter than the tiers. An interval
+    as long as a tier is not used, its buckets are aligned to UTC and would straddle local days.
+    """
+    tiers = list(ROLLUP_TIERS.values())
+    shorter = sorted((seconds, name) for name, seconds, *_ in intervals if seconds < min(tiers))
+    dividing = [item for item in shorter if all(tier % item[0] == 0 for tier in tiers)]
+    return (dividing or shorter)[-1][1] if shorter else None
+
+def init_rollup_source(c) -> None:
+    """Create the table recording the interval the rollups are built from, starting at LEGACY_ROLLUP_SOURCE"""
+    c.execute('''CREATE TABLE rollup_source
+    (id INTEGER PRIMARY KEY CHECK(id = 1),
+    interval TEXT)''')
+    c.execute('INSERT INTO rollup_source VALUES (1, ?)', (LEGACY_ROLLUP_SOURCE,))
+
+def rollup_source(c) -> Optional[str]:
+    """Interval whose rows feed the rollups, None if no configured interval can"""
+    c.execute('SELECT interval FROM rollup_source WHERE id = 1')
+    row = c.fetchone()
+    return row[0] if row else None
+
+def update_rollup_source(c) -> Optional[str]:
+    """Point the rollups at the interval chosen from the intervals table and return it.
+
+    When the choice changes, tier buckets are rebuilt from the new source's
+    stored rows. Buckets older than its first row keep their totals, so
+    history beyond its retention is not lost.
+    """
+    c.execute('SELECT name, seconds FROM intervals')
+    source = choose_rollup_source(c.fetchall())
+    if source == rollup_source(c):
+        return source
+    c.execute('UPDATE rollup_source SET interval = ? WHERE id = 1', (source,))
+    if source is not None:
+        for tier, seconds in ROLLUP_TIERS.items():
+            # The first bucket may hold only part of a day, rebuild_rollups keeps it if it held more rows
+            c.execute(f'''DELETE FROM rollups WHERE tier = ? AND timestamp >
+                       (SELECT MIN({rollup_bucket_sql(seconds)}) FROM metrics WHERE interval = ?)''', (tier, source))
+        c.execute('SELECT MIN(timestamp), MAX(timestamp) FROM metrics WHERE interval = ?', (source,))
+        start, end = c.fetchone()
+        if start is not None:
+            rebuild_rollups(c, source, start - 1, end)
+    return source
+
+def rollup_bucket_sql(seconds: int) -> str:
+    """SQL expression for the epoch start of the tier bucket holding a metrics row"""
+    # Rows are labelled with the end of their bucket, so one second earlier lies inside it.
+    # Flooring the local wall-clock time aligns tiers to local midnight, then it is turned back into epoch.
+    wall_clock = "CAST(strftime('%s', timestamp - 1, 'unixepoch', 'localtime') AS INTEGER)"
+    return f"CAST(strftime('%s', ({wall_clock} / {seconds}) * {seconds}, 'unixepoch', 'utc') AS INTEGER)"
+
+def rebuild_rollups(c, source: str, start: int, end: int) -> None:
+    """Recompute from metrics every rollup bucket holding source rows with start < timestamp <= end.
+
+    Used after stored rows were rewritten. A bucket is only replaced when the
+    rebuild counts at least as many rows as it holds, so days whose oldest
+    source rows already expired keep their totals.
+    """
+    updates = ',\n'.join(f'{name}_{stat} = excluded.{name}_{stat}'
+                         for name in HISTORY_METRICS for stat in ('sum', 'min', 'max'))
+    for tier, seconds in ROLLUP_TIERS.items():
+        bucket = rollup_bucket_sql(seconds)
+        # Widened to whole buckets, with an hour of slack either way for daylight saving shifts
+        c.execute(f'''INSERT INTO rollups
+                   SELECT ?, device, {bucket}, {ROLLUP_SELECTS}, COUNT(*)
+                   FROM metrics WHERE interval = ? AND timestamp > ? AND timestamp <= ?
+                   GROUP BY device, {bucket}
+                   ON CONFLICT (tier, device, timestamp) DO UPDATE SET
+                   {updates},
+                   num_rows = excluded.num_rows
+                   WHERE excluded.num_rows >= rollups.num_rows''',
+                  (tier, source, start - seconds - 3600, end + seconds + 3600))
+
+ROLLUP_UPSERT = '''INSERT INTO rollups VALUES ({placeholders})
+ON CONFLICT (tier, device, timestamp) DO UPDATE SET
+{updates},
+num_rows = num_rows + excluded.num_rows'''.format(
+    placeholders=', '.join('?' * (3 * len(HISTORY_METRICS) + 4)),
+    updates=',\n'.join(f'{name}_sum = {name}_sum + excluded.{name}_sum, '
+                       f'{name}_min = MIN({name}_min, excluded.{name}_min), '
+                       f'{name}_max = MAX({name}_max, excluded.{name}_max)'
+                       for name in HISTORY_METRICS))
+
+def rollup_params(tier: str, device: str, bucket_start: float, values: Dict[str, float]) -> tuple:
+    """Parameters of ROLLUP_UPSERT folding one source row (bucket start in epoch seconds) into a tier bucket"""
+    seconds = ROLLUP_TIERS[tier]
+    # Floor the local wall-clock time, so day buckets start at local midnight
+    wall_clock = (datetime.fromtimestamp(bucket_start) - WALL_CLOCK_EPOCH).total_seconds()
+    tier_start = WALL_CLOCK_EPOCH + timedelta(seconds=wall_clock - (wall_clock % seconds))
+    params = [tier, device, int(tier_start.timestamp())]
+    for name in HISTORY_METRICS:
+        params += [values[name]] * 3
+    params.append(1)
+    return tuple(params)
+
+def choose_tier(tiers: Sequence[Tuple[str, int, int]], start: datetime, end: datetime,
+                points: int, now: Optional[datetime] = None) -> Tuple[str, int]:
+    """Pick the finest tier that still covers start and keeps the rows read near points.
+
+    tiers are (name, seconds, retention_days) tuples. The number of rows read is
+    bounded by ROWS_PER_POINT * points whatever the length of the range.
+    """
+    now = now or datetime.now()
+    span = (end - start).total_seconds()
+    ordered = sorted(tiers, key=lambda tier: tier[1])
+    for name, seconds, retention_days in ordered:
+        covers = now - timedelta(days=retention_days) <= start
+        if covers and span / seconds <= points * ROWS_PER_POINT:
+            return name, seconds
+    return ordered[-1][0], ordered[-1][1]
+
+def downsample(conn, tier: str, start: datetime, end: datetime, points: int,
+               metrics: Sequence[str], device: Optional[str] = None) -> Dict[str, object]:
+    """Min/avg/max of each metric in up to points equal-width buckets over [start, end), all devices unless one is given"""
+    start_epoch = int(start.timestamp())
+    end_epoch = int(end.timestamp())
+    width = max((end_epoch - start_epoch) / points, 1)
+    bucket = '(timestamp - ?) / ?'
+    device_filter = 'AND device = ?' if device is not None else ''
+    if tier in ROLLUP_TIERS:
+        selects = ', '.join(f'SUM({name}_sum) / SUM(num_rows), MIN({name}_min), MAX({name}_max)'
+                            for name in metrics)
+        sql = f'''SELECT CAST({bucket} AS INTEGER) AS b, {selects}
+                  FROM rollups WHERE tier = ? {device_filter} AND timestamp >= ? AND timestamp < ?
+                  GROUP BY b ORDER BY b'''
+    else:
+        selects = ', '.join(f'AVG({HISTORY_METRICS[name]}), MIN({HISTORY_METRICS[name]}), MAX({HISTORY_METRICS[name]})'
+                            for name in metrics)
+        sql = f'''SELECT CAST({bucket} AS INTEGER) AS b, {selects}
+                  FROM metrics WHERE interval = ? {device_filter} AND timestamp >= ? AND timestamp < ?
+                  GROUP BY b ORDER BY b'''
+    params = [start_epoch, width, tier] + ([device] if device is not None else []) + [start_epoch, end_epoch]
+    rows = conn.execute(sql, params).fetchall()
+
+    result = {
+        'timestamps': [format_timestamp(start_epoch + row[0] * width) for row in rows],
+    }
+    for i, name in enumerate(metrics):
+        result[name] = {
+            'avg': [row[1 + 3 * i] for row in rows],
+            'min': [row[2 + 3 * i] for row in rows],
+            'max': [row[3 + 3 * i] for row in rows],
+        }
+    return result
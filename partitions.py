@@ -0,0 +1,130 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from sketch import SKETCH_COLUMNS
+
+# Columns of every metrics partition, in table order
+PARTITION_COLUMNS = ('interval', 'device', 'timestamp', 'temp1', 'temp2', 'pressure1', 'pressure2',
+                     'power', 'kw_ton', 'cooling_tons', 'flow_rate')
+# Added by the v7 migration, NULL in rows stored before it
+PARTITION_SKETCH_COLUMNS = tuple((column, 'BLOB' if column.endswith('_sketch') else 'REAL')
+                                 for column in SKETCH_COLUMNS)
+
+# Each interval's retention is split into about this many partitions, none shorter than a day.
+# Keeps the metrics view far below SQLite's 500-term compound select limit.
+PARTITIONS_PER_RETENTION = 8
+MIN_PARTITION_SECONDS = 24 * 3600
+
+def init_catalog(c) -> None:
+    c.execute('''CREATE TABLE IF NOT EXISTS partitions
+    (interval TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    name TEXT NOT NULL UNIQUE,
+    PRIMARY KEY (interval, start_time)) WITHOUT ROWID''')
+
+def create_partition_table(c, name: str) -> None:
+    # Every query filters on interval and usually device, then reads a timestamp range
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {name}
+    (interval TEXT NOT NULL,
+    device TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    temp1 REAL NOT NULL,
+    temp2 REAL NOT NULL,
+    pressure1 REAL NOT NULL,
+    pressure2 REAL NOT NULL,
+    power REAL NOT NULL,
+    kw_ton REAL NOT NULL,
+    cooling_tons REAL NOT NULL,
+    flow_rate REAL NOT NULL,
+    {''.join(f'{column} {column_type}, ' for column, column_type in PARTITION_SKETCH_COLUMNS)}
+    PRIMARY KEY (interval, device, timestamp)) WITHOUT ROWID''')
+
+def partition_seconds(retention_days: int) -> int:
+    """Length of new partitions for an interval, whole days"""
+    days = max(1, retention_days // PARTITIONS_PER_RETENTION)
+    return max(MIN_PARTITION_SECONDS, days * 24 * 3600)
+
+class PartitionManager:
+    def __init__(self, c, retention: Optional[Dict[str, int]] = None):
+        """Routes metrics rows to per-interval time partitions and keeps the metrics view in sync.
+
+        Only the storage writer calls this, always inside its transaction, so
+        partition creation commits or rolls back together with the rows.
+        retention (days per interval) is read from the intervals table when not given.
+        """
+        self._retention = retention
+        self._catalog = {}  # interval -> sorted [(start, end, name)]
+        c.execute('SELECT interval, start_time, end_time, name FROM partitions ORDER BY interval, start_time')
+        for interval, start, end, name in c.fetchall():
+            self._catalog.setdefault(interval, []).append((start, end, name))
+
+    def partitions(self, interval: str) -> List[Tuple[int, int, str]]:
+        return list(self._catalog.get(interval, ()))
+
+    def table_for(self, c, interval: str, timestamp: int) -> str:
+        """Name of the partition holding timestamp, created if needed"""
+        parts = self._catalog.get(interval, [])
+        # New rows almost always land in the newest partition
+        for start, end, name in reversed(parts):
+            if start <= timestamp < end:
+                return name
+            if end <= timestamp:
+                break
+        return self._create(c, interval, timestamp)
+
+    def _create(self, c, interval: str, timestamp: int) -> str:
+        if not re.fullmatch(r'\w+', interval):
+            raise ValueError(f"Invalid interval name: {interval}")
+        seconds = partition_seconds(self._retention_days(c, interval))
+        start = timestamp - timestamp % seconds
+        end = start + seconds
+        # Clip to neighbours created earlier with a different length
+        for other_start, other_end, _ in self._catalog.get(interval, []):
+            if other_end <= timestamp:
+                start = max(start, other_end)
+            elif other_start > timestamp:
+                end = min(end, other_start)
+        name = f'metrics_{interval}_{start}'
+        create_partition_table(c, name)
+        c.execute('INSERT INTO partitions VALUES (?, ?, ?, ?)', (interval, start, end, name))
+        self._catalog.setdefault(interval, []).append((start, end, name))
+        self._catalog[interval].sort()
+        self.rebuild_view(c)
+        return name
+
+    def _retention_days(self, c, interval: str) -> int:
+        if self._retention is not None:
+            return self._retention.get(interval, PARTITIONS_PER_RETENTION)
+        c.execute('SELECT retention_days FROM intervals WHERE name = ?', (interval,))
+        row = c.fetchone()
+        return row[0] if row else PARTITIONS_PER_RETENTION
+
+    def drop_expired(self, c, cutoffs: Dict[str, int]) -> int:
+        """Drop every partition whose rows are all older than its interval's cutoff"""
+        dropped = 0
+        for interval, cutoff in cutoffs.items():
+            keep = []
+            for start, end, name in self._catalog.get(interval, []):
+                if end <= cutoff:
+                    c.execute(f'DROP TABLE IF EXISTS {name}')
+                    c.execute('DELETE FROM partitions WHERE name = ?', (name,))
+                    dropped += 1
+                else:
+                    keep.append((start, end, name))
+            self._catalog[interval] = keep
+        if dropped:
+            self.rebuild_view(c)
+        return dropped
+
+    def rebuild_view(self, c) -> None:
+        """Recreate the metrics view as the union of all partitions"""
+        columns = ', '.join(PARTITION_COLUMNS + SKETCH_COLUMNS)
+        selects = [f'SELECT {columns} FROM {name}'
+                   for interval in sorted(self._catalog)
+                   for _, _, name in self._catalog[interval]]
+        if not selects:
+            selects = ['SELECT ' + ', '.join(f'NULL AS {column}' for column in PARTITION_COLUMNS + SKETCH_COLUMNS)
+                       + ' WHERE 0']
+        c.execute('DROP VIEW IF EXISTS metrics')
+        c.execute('CREATE VIEW metrics AS ' + '\nUNION ALL '.join(selects))
@@ -0,0 +1,258 @@
+import math
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from archive import RAW_FIELDS
+from calibration import FlowCalibration, np
+from history import rebuild_rollups, rollup_source
+from sketch import SKETCH_COLUMNS, SKETCH_METRICS, QuantileSketch, sketch_columns
+
+# Rows read and rewritten per transaction, and the pause after each so collector flushes get the write lock
+CHUNK_ROWS = 5000
+CHUNK_PAUSE = 0.05  # seconds
+ARCHIVE_MAX_SAMPLES = 200000  # Per row; longer buckets are recomputed from their means instead
+DERIVED_METRICS = ('kw_ton', 'cooling_tons', 'flow_rate')  # Columns depending on the calibration, derive_metrics order
+CLOSE_MARGIN = 5  # seconds after the cutoff for the buckets ending at it to be closed and queued for storage
+
+STATE_COLUMNS = ('status', 'coefficient', 'slope', 'cutoff', 'rows_done', 'rows_total', 'started', 'finished',
+                 'done_interval', 'done_start', 'last_device', 'last_timestamp', 'error')
+
+def init_state(c) -> None:
+    # One row: the current or last job and how far it got
+    c.execute('''CREATE TABLE IF NOT EXISTS recompute
+    (id INTEGER PRIMARY KEY CHECK(id = 1),
+    status TEXT NOT NULL,
+    coefficient REAL NOT NULL,
+    slope REAL NOT NULL,
+    cutoff INTEGER NOT NULL,
+    rows_done INTEGER NOT NULL,
+    rows_total INTEGER NOT NULL,
+    started INTEGER NOT NULL,
+    finished INTEGER,
+    done_interval TEXT,
+    done_start INTEGER,
+    last_device TEXT,
+    last_timestamp INTEGER,
+    error TEXT)''')
+
+def derive_metrics(calibration: FlowCalibration, pressure_diffs: Sequence[float], temp_diffs: Sequence[float],
+                   powers: Sequence[float]) -> Tuple[List[float], List[float], List[float]]:
+    """kw_ton, cooling_tons and flow_rate columns for columns of inputs, as DataAggregator.add_data_point computes them"""
+    flow_rates = calibration.calculate_flow_rates(pressure_diffs)
+    if np is not None:
+        cooling_tons = (flow_rates * np.asarray(temp_diffs, dtype=float) * 8.33 * 60) / 12000
+        kw_ton = np.zeros_like(cooling_tons)
+        np.divide(np.asarray(powers, dtype=float), cooling_tons, out=kw_ton, where=cooling_tons > 0)
+        return kw_ton.tolist(), cooling_tons.tolist(), flow_rates.tolist()
+    cooling_tons = [(flow_rate * temp_diff * 8.33 * 60) / 12000 for flow_rate, temp_diff in zip(flow_rates, temp_diffs)]
+    kw_ton = [power / tons if tons > 0 else 0 for power, tons in zip(powers, cooling_tons)]
+    return kw_ton, cooling_tons, flow_rates
+
+class Recomputer:
+    def __init__(self, storage, on_finished: Optional[Callable[[], None]] = None,
+                 open_until: Optional[Callable[[], float]] = None, archive_for: Optional[Callable] = None):
+        """Background job rewriting kw_ton, cooling_tons and flow_rate of stored rows after a recalibration.
+
+        Values are recomputed CHUNK_ROWS rows per transaction, partition by
+        partition. A row whose samples are in the raw archive (archive_for,
+        device -> SampleArchive), at most ARCHIVE_MAX_SAMPLES of them, gets
+        the mean of its per-sample values, as the collector computed them.
+        Any other row is recomputed from its stored mean pressures,
+        temperatures and power, which only approximates the mean of
+        per-sample kW/ton. The SKETCH_COLUMNS are rebuilt from the archived
+        samples too, and set to NULL on rows without them, so percentiles of
+        the old curve never sit next to new means. A request with the
+        coefficients of the last finished job rewrites nothing.
+        Buckets still open at the recalibration mix samples of both curves,
+        so the cutoff is the end of the newest of them (open_until) and the
+        job waits for those rows to be stored; later rows were computed with
+        the new curve only. The job's position is committed with every
+        chunk, so a job cut short by a restart continues where it stopped.
+        A new request while a job runs starts it over.
+        """
+        self.storage = storage
+        self.on_finished = on_finished
+        self.open_until = open_until
+        self.archive_for = archive_for
+        self.calibration = FlowCalibration(storage)
+        self._requested = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Start the worker thread, it first resumes an interrupted job"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def request(self) -> None:
+        """Recompute everything with the current calibration points"""
+        self._requested.set()
+
+    def progress(self) -> Optional[dict]:
+        """State of the current or last job, None if none ever ran"""
+        row = self.storage.query_one(f'SELECT {", ".join(STATE_COLUMNS)} FROM recompute WHERE id = 1')
+        if row is None:
+            return None
+        state = dict(zip(STATE_COLUMNS, row))
+        state['percent'] = 100.0 * state['rows_done'] / state['rows_total'] if state['rows_total'] else 100.0
+        return state
+
+    def _run(self) -> None:
+        state = self.progress()
+        resume = state is not None and state['status'] == 'running'
+        while True:
+            if not resume:
+                self._requested.wait()
+            self._requested.clear()
+            try:
+                if self._job(resume) and self.on_finished is not None:
+                    self.on_finished()
+            except sqlite3.Error as e:
+                print(f"Recompute failed: {e}")
+                try:
+                    self.storage.execute("UPDATE recompute SET status = 'failed', error = ? WHERE id = 1", (str(e),))
+                except sqlite3.Error:
+                    pass
+            resume = False
+
+    def _job(self, resume: bool) -> bool:
+        """Run or continue a job, returns False if a newer request interrupted it or there was nothing to do"""
+        self.calibration.reload()
+        state = self.progress()
+        unchanged = state is not None and (state['coefficient'], state['slope']) == self.calibration.coefficients
+        if not resume and unchanged and state['status'] == 'done':
+            return False  # Every stored row already uses these coefficients
+        if not resume or not unchanged:
+            state = self._begin()
+
+        cutoff = state['cutoff']
+        if not self._wait_for_cutoff(cutoff):
+            return False
+        done = (state['done_interval'], state['done_start']) if state['done_interval'] is not None else None
+        position = (state['last_device'], state['last_timestamp']) if state['last_device'] is not None else None
+        partitions = self.storage.query('''SELECT interval, start_time, end_time, name FROM partitions
+                                        WHERE start_time <= ? ORDER BY interval, start_time''', (cutoff,))
+        for interval, start, end, name in partitions:
+            if done is not None and (interval, start) <= done:
+                continue
+            try:
+                if not self._partition(interval, start, end, name, cutoff, position):
+                    return False
+            except sqlite3.OperationalError:
+                # Retention may drop a partition while the job runs, anything else is a real failure
+                if self.storage.query_one('SELECT 1 FROM partitions WHERE name = ?', (name,)) is not None:
+                    raise
+            position = None
+
+        self.storage.execute("UPDATE recompute SET status = 'done', finished = ? WHERE id = 1", (int(time.time()),))
+        return True
+
+    def _begin(self) -> dict:
+        started = int(time.time())
+        cutoff = max(started, math.ceil(self.open_until())) if self.open_until is not None else started
+        (total,) = self.storage.query_one('SELECT COUNT(*) FROM metrics WHERE timestamp <= ?', (cutoff,))
+        coefficient, slope = self.calibration.coefficients
+        self.storage.execute('''INSERT OR REPLACE INTO recompute
+                             (id, status, coefficient, slope, cutoff, rows_done, rows_total, started)
+                             VALUES (1, 'running', ?, ?, ?, 0, ?, ?)''',
+                             (coefficient, slope, cutoff, total, started))
+        return self.progress()
+
+    def _wait_for_cutoff(self, cutoff: int) -> bool:
+        """Wait until every row up to cutoff is stored, returns False if a newer request interrupted it"""
+        delay = cutoff + CLOSE_MARGIN - time.time()
+        if delay > 0:
+            if self._requested.wait(delay):
+                return False
+            self.storage.flush()
+            # The total counted at the start missed the rows stored while waiting
+            self.storage.execute('''UPDATE recompute SET rows_total = (SELECT COUNT(*) FROM metrics WHERE timestamp <= ?)
+                                 WHERE id = 1''', (cutoff,))
+        else:
+            # Aggregates computed before the recalibration must reach their partitions first
+            self.storage.flush()
+        return True
+
+    def _partition(self, interval: str, start: int, end: int, name: str, cutoff: int,
+                   position: Optional[Tuple[str, int]]) -> bool:
+        """Rewrite one partition from position on, returns False if a newer request interrupted it"""
+        seconds = None
+        if self.archive_for is not None:
+            row = self.storage.query_one('SELECT seconds FROM intervals WHERE name = ?', (interval,))
+            seconds = row[0] if row else None
+        while True:
+            if self._requested.is_set():
+                return False
+            after = 'AND (device, timestamp) > (?, ?)' if position is not None else ''
+            rows = self.storage.query(f'''SELECT device, timestamp, temp1, temp2, pressure1, pressure2, power
+                                      FROM {name}
+                                      WHERE interval = ? AND timestamp <= ? {after}
+                                      ORDER BY device, timestamp
+                                      LIMIT ?''', (interval, cutoff) + (position or ()) + (CHUNK_ROWS,))
+            if not rows:
+                break
+            devices, timestamps, temp1, temp2, pressure1, pressure2, powers = zip(*rows)
+            kw_ton, cooling_tons, flow_rates = derive_metrics(
+                self.calibration,
+                [abs(a - b) for a, b in zip(pressure1, pressure2)],
+                [abs(a - b) for a, b in zip(temp1, temp2)],
+                powers)
+            sketches = [(None,) * len(SKETCH_COLUMNS)] * len(rows)
+            if seconds is not None:
+                for i, (device, timestamp, power) in enumerate(zip(devices, timestamps, powers)):
+                    samples = self._archived(device, timestamp - seconds, timestamp, power)
+                    if samples is not None:
+                        kw_ton[i], cooling_tons[i], flow_rates[i] = (sum(column) / len(column) for column in samples)
+                        sketches[i] = self._sketch_columns(samples)
+            position = (devices[-1], timestamps[-1])
+            with self.storage.transaction() as c:
+                c.executemany(f'''UPDATE {name} SET kw_ton = ?, cooling_tons = ?, flow_rate = ?,
+                              {', '.join(f'{column} = ?' for column in SKETCH_COLUMNS)}
+                              WHERE interval = ? AND device = ? AND timestamp = ?''',
+                              [values + sketch + (interval, device, timestamp) for values, sketch, device, timestamp
+                               in zip(zip(kw_ton, cooling_tons, flow_rates), sketches, devices, timestamps)])
+                c.execute('''UPDATE recompute SET last_device = ?, last_timestamp = ?, rows_done = rows_done + ?
+                          WHERE id = 1''', position + (len(rows),))
+            time.sleep(CHUNK_PAUSE)
+
+        with self.storage.transaction() as c:
+            # Day rollups are sums over the source interval's rows, refresh the buckets this partition feeds
+            if interval == rollup_source(c):
+                rebuild_rollups(c, interval, start, min(end, cutoff))
+            c.execute('''UPDATE recompute SET done_interval = ?, done_start = ?, last_device = NULL, last_timestamp = NULL
+                      WHERE id = 1''', (interval, start))
+        return True
+
+    def _archived(self, device: str, start: int, end: int,
+                  power: float) -> Optional[Tuple[List[float], List[float], List[float]]]:
+        """Per-sample kw_ton, cooling_tons and flow_rate of the bucket [start, end) from the raw archive.
+
+        None unless the archive holds the bucket's samples, which is checked
+        by their power averaging to the stored mean.
+        """
+        columns = self.archive_for(device).read(start, end, ARCHIVE_MAX_SAMPLES + 1)
+        if len(columns['timestamp']) > ARCHIVE_MAX_SAMPLES:
+            return None
+        samples = [values for values in zip(*(columns[field] for field in RAW_FIELDS))
+                   if all(map(math.isfinite, values))]
+        if not samples:
+            return None
+        temp1, temp2, pressure1, pressure2, powers = zip(*samples)
+        if not math.isclose(sum(powers) / len(powers), power, rel_tol=1e-4, abs_tol=1e-3):
+            return None
+        return derive_metrics(self.calibration,
+                              [abs(a - b) for a, b in zip(pressure1, pressure2)],
+                              [abs(a - b) for a, b in zip(temp1, temp2)],
+                              powers)
+
+    @staticmethod
+    def _sketch_columns(samples: Sequence[Sequence[float]]) -> Tuple:
+        """SKETCH_COLUMNS values of a bucket from its per-sample derive_metrics columns"""
+        derived = dict(zip(DERIVED_METRICS, samples))
+        sketches = {metric: QuantileSketch() for metric in SKETCH_METRICS}
+        for metric, sketch in sketches.items():
+            for value in derived[metric]:
+                sketch.add(value)
+        return sketch_columns(sketches)
@@ -0,0 +1,92 @@
+from array import array
+from typing import Dict, Optional
+
+from aggregation import METRICS
+
+class SampleBuffer:
+    """Ring buffer of the raw samples of the last span seconds, stored as one float array per column.
+
+    Timestamps are epoch seconds and must be appended in increasing order so
+    that time windows can be located with a binary search. The capacity
+    doubles whenever the buffer is full but its oldest sample is still
+    within span, so it covers the span at whatever rate the sensor sends,
+    up to max_capacity samples.
+    """
+
+    def __init__(self, span: float, capacity: int = 1024, max_capacity: int = 1 << 20):
+        self.span = span
+        self.max_capacity = max_capacity
+        self.capacity = max(1, min(int(capacity), max_capacity))
+        self.timestamps = array('d', bytes(8 * self.capacity))
+        self.columns = {metric: array('d', bytes(8 * self.capacity)) for metric in METRICS}
+        self._head = 0  # Physical index of the oldest sample
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, timestamp: float, metrics: Dict[str, float]) -> None:
+        if (self._size == self.capacity < self.max_capacity and
+                timestamp - self.timestamps[self._head] < self.span):
+            self._grow(min(2 * self.capacity, self.max_capacity))
+        if self._size < self.capacity:
+            index = (self._head + self._size) % self.capacity
+            self._size += 1
+        else:
+            # Full, overwrite the oldest sample
+            index = self._head
+            self._head = (self._head + 1) % self.capacity
+        self.timestamps[index] = timestamp
+        for metric in METRICS:
+            self.columns[metric][index] = metrics[metric]
+
+    def _grow(self, capacity: int) -> None:
+        padding = bytes(8 * (capacity - self._size))
+        timestamps = self._slice(self.timestamps, 0, self._size) + array('d', padding)
+        columns = {metric: self._slice(self.columns[metric], 0, self._size) + array('d', padding)
+                   for metric in METRICS}
+        self.timestamps, self.columns = timestamps, columns
+        self._head = 0
+        self.capacity = capacity
+
+    # Copy logical positions [start, stop) of a column out of the ring
+    def _slice(self, column: array, start: int, stop: int) -> array:
+        first = self._head + start
+        last = self._head + stop
+        if last <= self.capacity:
+            return column[first:last]
+        if first >= self.capacity:
+            return column[first - self.capacity:last - self.capacity]
+        return column[first:] + column[:last - self.capacity]
+
+    # First logical position whose timestamp is >= value
+    def _bisect(self, value: float) -> int:
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[(self._head + mid) % self.capacity] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, start: float, end: float, limit: Optional[int] = None) -> Dict[str, array]:
+        """Columns of the samples with start <= timestamp < end, oldest first and at most limit of them"""
+        first = self._bisect(start)
+        last = self._bisect(end)
+        if limit is not None:
+            last = min(last, first + limit)
+        result = {'timestamp': self._slice(self.timestamps, first, last)}
+        for metric in METRICS:
+            result[metric] = self._slice(self.columns[metric], first, last)
+        return result
+
+    def latest(self) -> Optional[Dict[str, float]]:
+        """Most recent sample, or None when empty"""
+        if self._size == 0:
+            return None
+        index = (self._head + self._size - 1) % self.capacity
+        sample = {'timestamp': self.timestamps[index]}
+        for metric in METRICS:
+            sample[metric] = self.columns[metric][index]
+        return sample
@@ -0,0 +1,39 @@
+import heapq
+import time
+from typing import Dict, List, Optional, Tuple
+
+def next_boundary(seconds: int, epoch: float) -> float:
+    """First bucket boundary strictly after epoch"""
+    return epoch - epoch % seconds + seconds
+
+class BucketScheduler:
+    def __init__(self, intervals: Dict[str, int], grace: float = 0.0, now: Optional[float] = None):
+        """Upcoming bucket boundary of every interval, earliest first.
+
+        Boundaries are multiples of the interval length in epoch seconds, so
+        buckets line up with the wall clock. A close fires grace seconds after
+        its boundary, leaving time for samples stamped just before it to arrive.
+        """
+        self.grace = grace
+        now = time.time() if now is None else now
+        self._heap = [(next_boundary(seconds, now), name, seconds) for name, seconds in intervals.items()]
+        heapq.heapify(self._heap)
+
+    def next_deadline(self) -> Optional[float]:
+        """Epoch time the next close is due"""
+        return self._heap[0][0] + self.grace if self._heap else None
+
+    def due(self, now: Optional[float] = None) -> List[Tuple[str, float]]:
+        """(interval, boundary) of every close that is due, each interval rescheduled past now.
+
+        After a stall only the latest passed boundary of an interval fires;
+        buckets before it were either empty or already closed by a newer sample.
+        """
+        now = time.time() if now is None else now
+        fired = []
+        while self._heap and self._heap[0][0] + self.grace <= now:
+            _, name, seconds = heapq.heappop(self._heap)
+            passed = next_boundary(seconds, now - self.grace) - seconds
+            fired.append((name, passed))
+            heapq.heappush(self._heap, (passed + seconds, name, seconds))
+        return fired
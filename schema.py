@@ -0,0 +1,210 @@
+import sqlite3
+
+from history import (HISTORY_METRICS, LEGACY_ROLLUP_SOURCE, init_rollup_source, init_rollups,
+                     update_rollup_source)
+from partitions import (PARTITION_COLUMNS, PARTITION_SKETCH_COLUMNS, PartitionManager, create_partition_table,
+                        init_catalog)
+from recompute import init_state
+
+# Rows stored before devices were tracked came from the single default board
+LEGACY_DEVICE = 'ttyACM0'
+
+def _table_exists(c, name: str) -> bool:
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return c.fetchone() is not None
+
+def _column_types(c, table: str) -> dict:
+    c.execute(f'PRAGMA table_info({table})')
+    return {row[1]: row[2].upper() for row in c.fetchall()}
+
+def _create_metrics(c) -> None:
+    # Every query filters on interval first, so it leads the clustered key
+    c.execute('''CREATE TABLE metrics
+    (interval TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    temp1 REAL NOT NULL,
+    temp2 REAL NOT NULL,
+    pressure1 REAL NOT NULL,
+    pressure2 REAL NOT NULL,
+    power REAL NOT NULL,
+    kw_ton REAL NOT NULL,
+    cooling_tons REAL NOT NULL,
+    flow_rate REAL NOT NULL,
+    PRIMARY KEY (interval, timestamp)) WITHOUT ROWID''')
+
+def _v1_epoch_timestamps(c) -> None:
+    """Base schema; converts TEXT timestamps of older databases to integer epoch seconds"""
+    c.execute('''CREATE TABLE IF NOT EXISTS config
+    (id INTEGER PRIMARY KEY,
+    interval1_seconds INTEGER NOT NULL CHECK(interval1_seconds > 0),
+    interval2_seconds INTEGER NOT NULL CHECK(interval2_seconds > 0),
+    interval3_seconds INTEGER NOT NULL CHECK(interval3_seconds > 0),
+    retention_interval1 INTEGER NOT NULL CHECK(retention_interval1 > 0),
+    retention_interval2 INTEGER NOT NULL CHECK(retention_interval2 > 0),
+    retention_interval3 INTEGER NOT NULL CHECK(retention_interval3 > 0))''') # Configuration table
+
+    c.execute('''INSERT OR IGNORE INTO config VALUES
+    (1, 60, 900, 3600, 1, 7, 30)''') # Default configuration
+
+    c.execute('''CREATE TABLE IF NOT EXISTS calibration_points
+        (id INTEGER PRIMARY KEY,
+        pressure_diff REAL NOT NULL,
+        flow_rate REAL NOT NULL,
+        timestamp TEXT NOT NULL)''')
+
+    # Old timestamps are local wall-clock strings, the 'utc' modifier turns them into epoch seconds
+    to_epoch = "CAST(strftime('%s', timestamp, 'utc') AS INTEGER)"
+
+    if _table_exists(c, 'metrics') and _column_types(c, 'metrics').get('timestamp') == 'TEXT':
+        c.execute('ALTER TABLE metrics RENAME TO metrics_legacy')
+        c.execute('DROP INDEX IF EXISTS idx_timestamp_interval')
+        _create_metrics(c)
+        c.execute(f'''INSERT OR REPLACE INTO metrics
+                   SELECT interval, {to_epoch}, temp1, temp2, pressure1, pressure2,
+                          power, kw_ton, cooling_tons, flow_rate
+                   FROM metrics_legacy''')
+        c.execute('DROP TABLE metrics_legacy')
+    elif not _table_exists(c, 'metrics'):
+        _create_metrics(c)
+
+    legacy_rollups = _table_exists(c, 'rollups') and _column_types(c, 'rollups').get('timestamp') == 'TEXT'
+    if legacy_rollups:
+        c.execute('ALTER TABLE rollups RENAME TO rollups_legacy')
+    init_rollups(c, LEGACY_ROLLUP_SOURCE, f"'{LEGACY_DEVICE}'") # Daily min/avg/max rollups for long-range history
+    if legacy_rollups:
+        columns = ', '.join(f'{name}_sum, {name}_min, {name}_max' for name in HISTORY_METRICS)
+        c.execute(f'''INSERT OR REPLACE INTO rollups
+                   SELECT tier, ?, {to_epoch}, {columns}, num_rows FROM rollups_legacy''', (LEGACY_DEVICE,))
+        c.execute('DROP TABLE rollups_legacy')
+
+def _v2_time_partitions(c) -> None:
+    """Move metrics into per-interval time partitions behind a metrics view"""
+    init_catalog(c)
+    c.execute('ALTER TABLE metrics RENAME TO metrics_unpartitioned')
+    c.execute('SELECT retention_interval1, retention_interval2, retention_interval3 FROM config WHERE id = 1')
+    retention = dict(zip(('interval1', 'interval2', 'interval3'), c.fetchone()))
+    manager = PartitionManager(c, retention)
+
+    c.execute('SELECT DISTINCT interval FROM metrics_unpartitioned')
+    for (interval,) in c.fetchall():
+        c.execute('SELECT MIN(timestamp) FROM metrics_unpartitioned WHERE interval = ?', (interval,))
+        timestamp = c.fetchone()[0]
+        while timestamp is not None:
+            name = manager.table_for(c, interval, timestamp)
+            end = next(end for _, end, table in manager.partitions(interval) if table == name)
+            c.execute(f'''INSERT INTO {name} ({', '.join(PARTITION_COLUMNS)})
+                       SELECT interval, ?, timestamp, temp1, temp2, pressure1, pressure2,
+                              power, kw_ton, cooling_tons, flow_rate
+                       FROM metrics_unpartitioned
+                       WHERE interval = ? AND timestamp >= ? AND timestamp < ?''', (LEGACY_DEVICE, interval, timestamp, end))
+            c.execute('SELECT MIN(timestamp) FROM metrics_unpartitioned WHERE interval = ? AND timestamp >= ?',
+                      (interval, end))
+            timestamp = c.fetchone()[0]
+
+    c.execute('DROP TABLE metrics_unpartitioned')
+    manager.rebuild_view(c)
+
+def _v3_interval_table(c) -> None:
+    """Replace the fixed three-interval config row with one intervals row per interval"""
+    c.execute('''CREATE TABLE intervals
+    (name TEXT PRIMARY KEY,
+    seconds INTEGER NOT NULL CHECK(seconds > 0),
+    retention_days INTEGER NOT NULL CHECK(retention_days > 0)) WITHOUT ROWID''')
+    for n in (1, 2, 3):
+        c.execute(f'''INSERT INTO intervals
+                   SELECT 'interval{n}', interval{n}_seconds, retention_interval{n}
+                   FROM config WHERE id = 1''')
+    c.execute('DROP TABLE config')
+
+def _v4_devices(c) -> None:
+    """Add a device column to metrics and rollups, existing rows belong to LEGACY_DEVICE"""
+    c.execute('''CREATE TABLE devices
+    (id TEXT PRIMARY KEY,
+    port TEXT NOT NULL) WITHOUT ROWID''')
+
+    # Renaming a table would rewrite the view over it, the view is rebuilt below
+    c.execute('DROP VIEW IF EXISTS metrics')
+    columns = ', '.join(column for column in PARTITION_COLUMNS if column != 'device')
+    c.execute('SELECT name FROM partitions')
+    for (name,) in c.fetchall():
+        if 'device' in _column_types(c, name):
+            continue
+        c.execute(f'ALTER TABLE {name} RENAME TO {name}_legacy')
+        create_partition_table(c, name)
+        c.execute(f'''INSERT INTO {name} (device, {columns})
+                   SELECT ?, {columns} FROM {name}_legacy''', (LEGACY_DEVICE,))
+        c.execute(f'DROP TABLE {name}_legacy')
+    PartitionManager(c).rebuild_view(c)
+
+    if 'device' not in _column_types(c, 'rollups'):
+        c.execute('ALTER TABLE rollups RENAME TO rollups_legacy')
+        init_rollups(c, LEGACY_ROLLUP_SOURCE)
+        rollup_columns = ', '.join(f'{name}_sum, {name}_min, {name}_max' for name in HISTORY_METRICS)
+        c.execute(f'''INSERT OR REPLACE INTO rollups
+                   SELECT tier, ?, timestamp, {rollup_columns}, num_rows FROM rollups_legacy''', (LEGACY_DEVICE,))
+        c.execute('DROP TABLE rollups_legacy')
+
+    c.execute("INSERT INTO devices SELECT DISTINCT device, '/dev/' || device FROM metrics")
+
+def _v5_recompute_state(c) -> None:
+    """Progress table of the job that recomputes derived metrics after a recalibration"""
+    init_state(c)
+
+def _v6_bucket_checkpoints(c) -> None:
+    """Open aggregation buckets of each device, saved every few seconds and resumed after a restart"""
+    c.execute('''CREATE TABLE bucket_state
+    (device TEXT PRIMARY KEY,
+    saved INTEGER NOT NULL,
+    state TEXT NOT NULL) WITHOUT ROWID''')
+
+def _v7_bucket_sketches(c) -> None:
+    """Add the percentile and quantile sketch columns to every metrics partition, older rows keep NULLs"""
+    c.execute('DROP VIEW IF EXISTS metrics')
+    c.execute('SELECT name FROM partitions')
+    for (name,) in c.fetchall():
+        existing = _column_types(c, name)
+        for column, column_type in PARTITION_SKETCH_COLUMNS:
+            if column not in existing:
+                c.execute(f'ALTER TABLE {name} ADD COLUMN {column} {column_type}')
+    PartitionManager(c).rebuild_view(c)
+
+def _v8_rollup_source(c) -> None:
+    """Record which interval feeds the rollups, rebuilt from another one if interval3 was renamed or removed"""
+    init_rollup_source(c)
+    update_rollup_source(c)
+
+# Applied in order, PRAGMA user_version records how many have run
+MIGRATIONS = [
+    _v1_epoch_timestamps,
+    _v2_time_partitions,
+    _v3_interval_table,
+    _v4_devices,
+    _v5_recompute_state,
+    _v6_bucket_checkpoints,
+    _v7_bucket_sketches,
+    _v8_rollup_source,
+]
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """Bring the database up to the current schema without losing stored data"""
+    c = conn.cursor()
+
+    # Space freed by dropped partitions is returned with PRAGMA incremental_vacuum.
+    # Switching an existing file over needs one full VACUUM, which cannot run in a transaction.
+    c.execute('PRAGMA auto_vacuum')
+    if c.fetchone()[0] != 2:
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        c.execute('VACUUM')
+
+    c.execute('PRAGMA user_version')
+    version = c.fetchone()[0]
+    for target in range(version + 1, len(MIGRATIONS) + 1):
+        # Explicit BEGIN so table changes roll back together with the data copies
+        c.execute('BEGIN')
+        try:
+            MIGRATIONS[target - 1](c)
+            c.execute(f'PRAGMA user_version = {target}')
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
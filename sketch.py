@@ -0,0 +1,146 @@
+import math
+import struct
+from typing import Dict, Iterable, Optional, Tuple
+
+# Metrics whose distribution is kept per bucket, with the percentiles stored next to their mean
+SKETCH_METRICS = ('kw_ton',)
+SKETCH_PERCENTILES = (5, 50, 95)
+# Extra columns of a metrics row: <metric>_p<n> for every percentile, then the serialized sketch
+SKETCH_COLUMNS = tuple(f'{metric}_p{p}' for metric in SKETCH_METRICS for p in SKETCH_PERCENTILES) + \
+                 tuple(f'{metric}_sketch' for metric in SKETCH_METRICS)
+
+SKETCH_ACCURACY = 0.01  # Relative error of every estimate, fixed so all stored sketches can be merged
+SKETCH_MAX_BINS = 256  # Per sketch; beyond it the smallest magnitudes lose accuracy first
+SKETCH_MIN_VALUE = 1e-9  # Smaller magnitudes are counted as zero
+
+# Serialized sketch: header, then one bin per positive and negative key
+SKETCH_VERSION = 1
+SKETCH_HEADER = struct.Struct('<BHHIdd')  # version, positive bins, negative bins, zeros, min, max
+SKETCH_BIN = struct.Struct('<hI')  # key, count
+SKETCH_MIN_KEY, SKETCH_MAX_KEY = -2 ** 15, 2 ** 15 - 1  # Keys beyond the int16 of a bin share its outermost bin
+
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+class QuantileSketch:
+    """Bounded-memory quantile estimates of a stream (DDSketch, Masson et al. 2019).
+
+    Values are counted in logarithmic bins, so every quantile is within
+    SKETCH_ACCURACY of the true value relative to it, and two sketches merge
+    exactly by adding their bin counts.
+    """
+    __slots__ = ('positive', 'negative', 'zero', 'count', 'min', 'max')
+
+    def __init__(self):
+        self.positive = {}  # key -> count
+        self.negative = {}  # key of the magnitude -> count
+        self.zero = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        if not math.isfinite(value):
+            return
+        if value > SKETCH_MIN_VALUE:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < -SKETCH_MIN_VALUE:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zero += 1
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.positive) + len(self.negative) > SKETCH_MAX_BINS:
+            self._collapse()
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while len(self.positive) + len(self.negative) > SKETCH_MAX_BINS:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        # Fold the two bins of smallest magnitude in the larger store together
+        bins = self.positive if len(self.positive) >= len(self.negative) else self.negative
+        lowest, second = sorted(bins)[:2]
+        bins[second] += bins.pop(lowest)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate of the q quantile (0..1), None while empty"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(self.min, -self._value(key))
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(self.max, self._value(key))
+        return self.max
+
+    @staticmethod
+    def _key(magnitude: float) -> int:
+        return min(max(math.ceil(math.log(magnitude) / _LOG_GAMMA), SKETCH_MIN_KEY), SKETCH_MAX_KEY)
+
+    @staticmethod
+    def _value(key: int) -> float:
+        # Midpoint of the bin in relative terms, within SKETCH_ACCURACY of all its values
+        return 2 * _GAMMA ** key / (_GAMMA + 1)
+
+    def to_bytes(self) -> bytes:
+        parts = [SKETCH_HEADER.pack(SKETCH_VERSION, len(self.positive), len(self.negative), self.zero,
+                                    self.min, self.max)]
+        parts += [SKETCH_BIN.pack(key, count) for key, count in sorted(self.positive.items())]
+        parts += [SKETCH_BIN.pack(key, count) for key, count in sorted(self.negative.items())]
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'QuantileSketch':
+        """Sketch serialized by to_bytes. Raises ValueError for anything else."""
+        try:
+            version, positive, negative, zero, low, high = SKETCH_HEADER.unpack_from(data)
+            if version != SKETCH_VERSION:
+                raise ValueError(f"Unsupported sketch version {version}")
+            bins = list(SKETCH_BIN.iter_unpack(data[SKETCH_HEADER.size:]))
+        except struct.error as e:
+            raise ValueError(f"Invalid sketch: {e}")
+        if len(bins) != positive + negative:
+            raise ValueError("Invalid sketch: bin count does not match its header")
+        sketch = cls()
+        sketch.positive = dict(bins[:positive])
+        sketch.negative = dict(bins[positive:])
+        sketch.zero = zero
+        sketch.count = zero + sum(count for _, count in bins)
+        sketch.min, sketch.max = low, high
+        return sketch
+
+def sketch_columns(sketches: Dict[str, QuantileSketch]) -> Tuple:
+    """Values of SKETCH_COLUMNS for the sketches of one bucket"""
+    values = [sketches[metric].quantile(p / 100) for metric in SKETCH_METRICS for p in SKETCH_PERCENTILES]
+    values += [sketches[metric].to_bytes() if sketches[metric].count else None for metric in SKETCH_METRICS]
+    return tuple(values)
+
+def merge_stored(blobs: Iterable[Optional[bytes]]) -> QuantileSketch:
+    """One sketch from serialized sketches of stored rows, rows stored without one are skipped"""
+    merged = QuantileSketch()
+    for blob in blobs:
+        if blob is not None:
+            merged.merge(QuantileSketch.from_bytes(blob))
+    return merged
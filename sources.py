@@ -0,0 +1,235 @@
+import asyncio
+import csv
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from Sensor import Sensor
+
+# Sensor specs name a simulated or replayed board instead of a serial port:
+#   sim:<name>?rate=50&noise=0.01&drift=0.02&dropout=0.01&malformed=0.001&seed=1
+#   replay:<path to Measurement_data_*.csv or raw archive directory>?speed=10&name=<device>
+# Add pty=1 to either to feed the real serial reader through a pseudo-terminal (POSIX).
+SOURCE_SCHEMES = ('sim', 'replay')
+
+# Readings of the simulated chiller loop: supply/return temperatures, pressures and power
+SIMULATED_BASE = (12.0, 7.0, 3.2, 2.9, 50.0)
+
+def format_line(values) -> bytes:
+    """One sample as the firmware prints it"""
+    return (','.join(f'{value:.2f}' for value in values) + '\n').encode('ascii')
+
+class SimulatedSource:
+    def __init__(self, rate: float = 1.0, noise: float = 0.01, drift: float = 0.0, dropout: float = 0.0,
+                 malformed: float = 0.0, seed: int = 0):
+        """Endless, reproducible firmware output.
+
+        noise is the standard deviation of each reading relative to its base
+        value, drift the relative change of every base value per hour. dropout
+        and malformed are the chances that a sample is skipped or replaced by a
+        garbled line. The same arguments always give the same lines.
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.noise = noise
+        self.drift = drift
+        self.dropout = dropout
+        self.malformed = malformed
+        self.seed = seed
+
+    def __iter__(self) -> Iterator[Tuple[float, bytes]]:
+        """(seconds after the start, line) pairs"""
+        rng = random.Random(self.seed)
+        index = 0
+        while True:
+            offset = index / self.rate
+            index += 1
+            if rng.random() < self.dropout:
+                continue
+            if rng.random() < self.malformed:
+                yield offset, bytes(rng.randrange(32, 127) for _ in range(rng.randrange(1, 30))) + b'\n'
+                continue
+            scale = 1 + self.drift * offset / 3600
+            yield offset, format_line(base * scale * (1 + rng.gauss(0, self.noise)) for base in SIMULATED_BASE)
+
+class ReplaySource:
+    def __init__(self, path: str, speed: float = 1.0, power: float = 0.0):
+        """Recorded samples with their original spacing, speed times faster; 0 sends them as fast as possible.
+
+        path is a CSV written by sensor_tester.py or a device directory of the
+        raw sample archive. The CSVs have no power column, power is used instead.
+        """
+        if speed < 0:
+            raise ValueError("speed must not be negative")
+        if not os.path.exists(path):
+            raise ValueError(f"No such file or directory: {path}")
+        self.path = path
+        self.speed = speed
+        self.power = power
+
+    def _records(self) -> Iterator[Tuple[float, bytes]]:
+        if os.path.isdir(self.path):
+            from archive import SampleArchive, RAW_FIELDS  # Only archive replays need it
+            columns = SampleArchive(self.path).read(0, float('inf'))
+            for i, timestamp in enumerate(columns['timestamp']):
+                yield timestamp, format_line(columns[field][i] for field in RAW_FIELDS)
+            return
+        with open(self.path, newline='') as f:
+            for row in csv.DictReader(f):
+                timestamp = datetime.fromisoformat(row['Timestamps']).timestamp()
+                readings = [row['Temperature 1'], row['Temperature 2'], row['Pressure 1'], row['Pressure 2'],
+                            row.get('Power') or str(self.power)]
+                # Empty readings stay empty, the reader counts them as parse errors like the real board's
+                yield timestamp, (','.join(readings) + '\n').encode('ascii')
+
+    def __iter__(self) -> Iterator[Tuple[float, bytes]]:
+        first = None
+        for timestamp, line in self._records():
+            if first is None:
+                first = timestamp
+            yield ((timestamp - first) / self.speed if self.speed else 0.0), line
+
+def parse_spec(port: str) -> Tuple[Optional[str], str, Dict[str, str]]:
+    """(scheme, target, options) of a sensor spec, scheme is None for a serial port"""
+    scheme, sep, rest = port.partition(':')
+    if not sep or scheme not in SOURCE_SCHEMES:
+        return None, port, {}
+    target, _, query = rest.partition('?')
+    return scheme, target, dict(parse_qsl(query))
+
+def make_source(port: str):
+    """Source for a sensor spec, None for a serial port. Raises ValueError for a bad spec."""
+    scheme, target, options = parse_spec(port)
+    if scheme is None:
+        return None
+    options = {name: value for name, value in options.items() if name not in ('pty', 'name')}
+    try:
+        if scheme == 'sim':
+            floats = {name: float(options.pop(name)) for name in ('rate', 'noise', 'drift', 'dropout', 'malformed')
+                      if name in options}
+            seed = int(options.pop('seed', 0))
+            source = SimulatedSource(seed=seed, **floats)
+        else:
+            floats = {name: float(options.pop(name)) for name in ('speed', 'power') if name in options}
+            source = ReplaySource(target, **floats)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid sensor spec {port}: {e}")
+    if options:
+        raise ValueError(f"Invalid sensor spec {port}: unknown options {', '.join(options)}")
+    return source
+
+def device_id(port: str) -> str:
+    """Device id of a serial port or sensor spec"""
+    scheme, target, options = parse_spec(port)
+    if scheme is None:
+        return Sensor.device_id(port)
+    name = options.get('name') or (target if scheme == 'sim' else os.path.splitext(os.path.basename(target))[0])
+    return re.sub(r'[^\w.-]', '_', name) or scheme
+
+def open_sensor(port: str, binary: bool = False) -> Sensor:
+    """Sensor for a serial port or a sensor spec, not yet started"""
+    source = make_source(port)
+    if source is None:
+        return Sensor(port, binary=binary)
+    if parse_spec(port)[2].get('pty') == '1':
+        return PtySensor(source, port)
+    return SourceSensor(source, port)
+
+class SourceSensor(Sensor):
+    def __init__(self, source, port: str, queue_size: int = 1024):
+        """Sensor fed in-process from a source, lines go through the same decoder as serial data"""
+        self.port = port
+        self.device = device_id(port)
+        self.source = source
+        self._init_buffers(queue_size)
+        self._task = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._running.set()
+            self._thread = threading.Thread(target=self._source_loop, daemon=True)
+            self._thread.start()
+
+    def _source_loop(self) -> None:
+        started = time.monotonic()
+        for offset, line in self.source:
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not self._running.is_set():
+                return
+            self._feed(line, time.time())
+        self._running.clear()  # Replay finished, get() reports it like a lost port
+        self._ready.set()
+
+    def start_async(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self._task is None and self._thread is None:
+            self._running.set()
+            self._loop = loop
+            self._async_ready = asyncio.Event()
+            self._task = loop.create_task(self._source_task())
+
+    async def _source_task(self) -> None:
+        started = time.monotonic()
+        for offset, line in self.source:
+            delay = started + offset - time.monotonic()
+            # Fast replays still yield to the loop now and then
+            await asyncio.sleep(max(delay, 0))
+            self._feed(line, time.time())
+            self._async_ready.set()
+        self._running.clear()
+        self._async_ready.set()
+
+    def close(self) -> None:
+        self._running.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._loop = None
+        if self._thread is not None:
+            if self._thread is not threading.current_thread():
+                self._thread.join(timeout=1)
+            self._thread = None
+
+class PtySensor(Sensor):
+    def __init__(self, source, port: str, **kwargs):
+        """Real serial Sensor on a pseudo-terminal that a thread writes the source's lines into"""
+        import pty  # POSIX only
+        import tty
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self._writing = threading.Event()
+        self._writing.set()
+        self._writer = threading.Thread(target=self._write_loop, args=(source,), daemon=True)
+        super().__init__(os.ttyname(self._slave), **kwargs)
+        self.port = port
+        self.device = device_id(port)
+        self._writer.start()
+
+    def _write_loop(self, source) -> None:
+        started = time.monotonic()
+        for offset, line in source:
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not self._writing.is_set():
+                return
+            try:
+                os.write(self._master, line)
+            except OSError:
+                return
+
+    def close(self) -> None:
+        self._writing.clear()
+        super().close()
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
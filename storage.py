@@ -0,0 +1,263 @@
+import sqlite3
+import queue
+import threading
+import time
+from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from instrumentation import registry
+from partitions import PartitionManager
+from sketch import SKETCH_COLUMNS
+
+DB_PATH = 'metrics.db'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Column order of metrics rows as the collector produces them
+METRICS_COLUMNS = ('timestamp', 'temp1', 'temp2', 'pressure1', 'pressure2', 'power',
+                   'kw_ton', 'cooling_tons', 'flow_rate') + SKETCH_COLUMNS + ('device', 'interval')
+# Metrics rows are routed to their time partition when flushed
+METRICS_INSERT = 'INSERT OR REPLACE INTO {{table}} ({}) VALUES ({})'.format(
+    ', '.join(METRICS_COLUMNS), ', '.join('?' * len(METRICS_COLUMNS)))
+
+FLUSH_SECONDS = registry.histogram('logger_storage_flush_seconds',
+                                   'Time to write one batch of queued statements, commit included')
+COMMIT_SECONDS = registry.histogram('logger_storage_commit_seconds', 'Time spent in COMMIT of a write transaction')
+ROWS_WRITTEN = registry.counter('logger_storage_statements_written_total', 'Queued statements written to the database')
+FLUSH_FAILURES = registry.counter('logger_storage_flush_failures_total', 'Batches rolled back and queued again')
+STATEMENTS_DROPPED = registry.counter('logger_storage_statements_dropped_total',
+                                      'Queued statements given up on, rejected by the database or over max_pending',
+                                      ('reason',))
+
+# Errors caused by the statement itself; retrying it can never succeed
+PERMANENT_ERRORS = (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.InterfaceError, sqlite3.ProgrammingError)
+
+def format_timestamp(epoch: float) -> str:
+    """Local time string used by the JSON APIs for an epoch timestamp"""
+    return datetime.fromtimestamp(epoch).strftime(TIMESTAMP_FORMAT)
+
+def parse_timestamp(value: str) -> int:
+    """Epoch seconds from an API timestamp string or a plain integer"""
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
+class Storage:
+    def __init__(self, path: str = DB_PATH, flush_interval: float = 5.0, flush_size: int = 50,
+                 max_pending: int = 100000):
+        """Single owner of the metrics database.
+
+        Aggregated rows are queued and written by a background thread in grouped
+        transactions, so the collector never waits on an fsync. Reads go through
+        a small pool of WAL readers that do not block behind the writer.
+        Statements the database rejects are dropped; while it cannot be written
+        at all, at most max_pending statements are kept, the oldest go first.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self._pending = queue.Queue()
+        self._write_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._conn = self._connect()
+        self.partitions = PartitionManager(self._conn.cursor())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')  # Readers never wait on the writer
+        conn.execute('PRAGMA synchronous=NORMAL')  # fsync on checkpoint, not on every commit
+        return conn
+
+    def start(self) -> None:
+        """Start the background flush thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        """Flush pending rows and close all connections"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._write_lock:
+            self._conn.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+    # Queue an aggregated metrics row for the next grouped write
+    def insert_metrics(self, row: Sequence) -> None:
+        self.enqueue(METRICS_INSERT, row)
+
+    def enqueue(self, sql: str, params: Sequence = ()) -> None:
+        """Queue any write statement for the next grouped transaction"""
+        self._pending.put((sql, tuple(params)))
+        self._trim()
+        if self._pending.qsize() >= self.flush_size:
+            self._wakeup.set()  # Let the flush thread write early
+
+    @property
+    def pending(self) -> int:
+        """Statements queued for the next flush"""
+        return self._pending.qsize()
+
+    def _trim(self) -> None:
+        while self._pending.qsize() > self.max_pending:
+            try:
+                self._pending.get_nowait()
+            except queue.Empty:
+                return
+            STATEMENTS_DROPPED.inc(reason='overflow')
+
+    def _drain(self) -> List[tuple]:
+        rows = []
+        while True:
+            try:
+                rows.append(self._pending.get_nowait())
+            except queue.Empty:
+                return rows
+
+    def flush(self) -> int:
+        """Write all queued statements in one transaction, returns the number written"""
+        with self._write_lock:
+            pending = self._drain()
+            if not pending:
+                return 0
+            started = time.perf_counter()
+            try:
+                self._write(pending)
+            except PERMANENT_ERRORS as e:
+                # A bad row must not hold back the rest: write one at a time and drop what is rejected
+                print(f"Storage flush failed: {e}, retrying statement by statement")
+                return self._write_each(pending)
+            except sqlite3.Error as e:
+                # Locked or full database, keep the batch for the next attempt rather than losing it
+                self._requeue(pending)
+                print(f"Storage flush failed: {e}")
+                FLUSH_FAILURES.inc()
+                return 0
+            FLUSH_SECONDS.observe(time.perf_counter() - started)
+            ROWS_WRITTEN.inc(len(pending))
+            return len(pending)
+
+    def _write(self, pending: List[tuple]) -> None:
+        statements = [item for item in pending if item[0] != METRICS_INSERT]
+        try:
+            with self._transaction() as c:
+                by_table = defaultdict(list)
+                for sql, row in pending:
+                    if sql == METRICS_INSERT:
+                        by_table[self.partitions.table_for(c, row[-1], row[0])].append(row)
+                for table, rows in by_table.items():
+                    c.executemany(METRICS_INSERT.format(table=table), rows)
+
+                # Runs of the same statement go through executemany, keeping queue order
+                start = 0
+                for end in range(1, len(statements) + 1):
+                    if end == len(statements) or statements[end][0] != statements[start][0]:
+                        c.executemany(statements[start][0], [params for _, params in statements[start:end]])
+                        start = end
+        except sqlite3.Error:
+            self.partitions = PartitionManager(self._conn.cursor())  # Forget partitions that were rolled back
+            raise
+
+    def _write_each(self, pending: List[tuple]) -> int:
+        written = 0
+        for i, item in enumerate(pending):
+            try:
+                self._write([item])
+            except PERMANENT_ERRORS as e:
+                print(f"Storage dropped a statement: {e}")
+                STATEMENTS_DROPPED.inc(reason='rejected')
+                continue
+            except sqlite3.Error as e:
+                self._requeue(pending[i:])
+                print(f"Storage flush failed: {e}")
+                FLUSH_FAILURES.inc()
+                break
+            written += 1
+        ROWS_WRITTEN.inc(written)
+        return written
+
+    def _requeue(self, items: List[tuple]) -> None:
+        for item in items:
+            self._pending.put(item)
+        self._trim()
+
+    def drop_expired(self, cutoffs: Dict[str, int]) -> int:
+        """Drop whole metrics partitions older than each interval's cutoff epoch"""
+        with self._write_lock:
+            with self._transaction() as c:
+                return self.partitions.drop_expired(c, cutoffs)
+
+    def incremental_vacuum(self, pages: int = 256) -> int:
+        """Return up to pages free pages to the file system, returns the free pages left"""
+        with self._write_lock:
+            # executescript steps the pragma to completion, execute() would free a single page
+            self._conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+            return self._conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def execute(self, sql: str, params: Iterable = ()) -> int:
+        """Run a single write statement immediately and commit it"""
+        with self._write_lock:
+            with self._transaction() as c:
+                return c.execute(sql, tuple(params)).rowcount
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Iterable]) -> int:
+        """Run a write statement for every parameter set in one transaction"""
+        with self._write_lock:
+            with self._transaction() as c:
+                return c.executemany(sql, seq_of_params).rowcount
+
+    @contextmanager
+    def transaction(self):
+        """Cursor for several write statements committed together"""
+        with self._write_lock:
+            with self._transaction() as c:
+                yield c
+
+    @contextmanager
+    def _transaction(self):
+        # Explicit BEGIN, the sqlite3 module would leave CREATE/DROP TABLE outside the transaction
+        c = self._conn.cursor()
+        c.execute('BEGIN')
+        try:
+            yield c
+        except BaseException:
+            self._conn.rollback()
+            raise
+        with COMMIT_SECONDS.time():
+            self._conn.commit()
+
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection from the pool"""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def query(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        with self.reader() as conn:
+            return conn.execute(sql, tuple(params)).fetchall()
+
+    def query_one(self, sql: str, params: Iterable = ()) -> Optional[tuple]:
+        with self.reader() as conn:
+            return conn.execute(sql, tuple(params)).fetchone()
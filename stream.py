@@ -0,0 +1,62 @@
+import asyncio
+import json
+import queue
+import threading
+from typing import Iterable, Optional
+
+class Broadcaster:
+    def __init__(self, queue_size: int = 100):
+        """Fan out events from the collector to every connected stream client.
+
+        Each client gets its own bounded queue; a client that stops reading
+        loses its oldest events instead of slowing down the publisher.
+        """
+        self.queue_size = queue_size
+        self._subscribers = {}  # queue -> (topics it wants, device it wants), None for everything
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics: Optional[Iterable[str]] = None, device: Optional[str] = None,
+                  asynchronous: bool = False):
+        """New client queue; an asyncio.Queue when asynchronous, which must then be published to from its loop"""
+        q = asyncio.Queue(maxsize=self.queue_size) if asynchronous else queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[q] = (set(topics) if topics is not None else None, device)
+        return q
+
+    def unsubscribe(self, q) -> None:
+        with self._lock:
+            self._subscribers.pop(q, None)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: str, data, topic: Optional[str] = None, device: Optional[str] = None) -> None:
+        """Send an event to every subscriber, or only those subscribed to topic and device"""
+        if not self._subscribers:
+            return
+        message = format_event(event, data)
+        with self._lock:
+            subscribers = [q for q, (topics, wanted) in self._subscribers.items()
+                           if (topic is None or topics is None or topic in topics)
+                           and (device is None or wanted is None or device == wanted)]
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except (queue.Full, asyncio.QueueFull):
+                try:
+                    q.get_nowait()  # Drop the oldest event for this slow client
+                except (queue.Empty, asyncio.QueueEmpty):
+                    pass
+                try:
+                    q.put_nowait(message)
+                except (queue.Full, asyncio.QueueFull):
+                    pass
+
+def format_event(event: Optional[str], data) -> str:
+    """Encode one Server-Sent Events message"""
+    lines = []
+    if event:
+        lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,150 @@
+import bisect
+import math
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Metrics summarised per window, all columns of the metrics table
+SUMMARY_METRICS = ('kw_ton', 'cooling_tons', 'flow_rate', 'power')
+# Rolling windows, name -> seconds
+SUMMARY_WINDOWS = {'5m': 300, '1h': 3600, '24h': 86400, '7d': 604800}
+SUMMARY_PERCENTILES = (5, 50, 95)
+SUMMARY_POINTS = 60  # Rows a window should span, picks the interval that feeds it
+
+def choose_sources(intervals: Iterable[Sequence], windows: Dict[str, int] = SUMMARY_WINDOWS,
+                   points: int = SUMMARY_POINTS) -> Dict[str, str]:
+    """Interval feeding each window: the longest one that still gives points rows, else the shortest.
+
+    intervals are (name, seconds, ...) rows as load_intervals returns them.
+    """
+    ordered = sorted((seconds, name) for name, seconds, *_ in intervals)
+    if not ordered:
+        return {}
+    sources = {}
+    for window, seconds in windows.items():
+        fitting = [name for length, name in ordered if length * points <= seconds]
+        sources[window] = fitting[-1] if fitting else ordered[0][1]
+    return sources
+
+def percentile(ordered: List[float], p: float) -> float:
+    """Linear interpolation between the closest ranks of a sorted, non-empty list"""
+    position = (len(ordered) - 1) * p / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+class Window:
+    __slots__ = ('seconds', 'rows', 'sums', 'ordered')
+
+    def __init__(self, seconds: int):
+        """Rows of one device within seconds of now, updated as rows arrive and expire.
+
+        Every metric keeps a running sum and a sorted list of its values, so
+        mean, min, max and percentiles are read without a pass over the rows.
+        Values that are not finite are left out of their metric.
+        """
+        self.seconds = seconds
+        self.rows = deque()  # (timestamp, values) oldest first
+        self.sums = [0.0] * len(SUMMARY_METRICS)
+        self.ordered = [[] for _ in SUMMARY_METRICS]
+
+    def add(self, timestamp: int, values: Tuple[float, ...]) -> None:
+        if self.rows and timestamp <= self.rows[-1][0]:
+            return  # Already counted, rows of an interval arrive in time order
+        self.rows.append((timestamp, values))
+        for i, value in enumerate(values):
+            if math.isfinite(value):
+                self.sums[i] += value
+                bisect.insort(self.ordered[i], value)
+
+    def expire(self, now: float) -> None:
+        cutoff = now - self.seconds
+        while self.rows and self.rows[0][0] <= cutoff:
+            _, values = self.rows.popleft()
+            for i, value in enumerate(values):
+                if math.isfinite(value):
+                    self.sums[i] -= value
+                    ordered = self.ordered[i]
+                    del ordered[bisect.bisect_left(ordered, value)]
+        if not self.rows:
+            self.sums = [0.0] * len(SUMMARY_METRICS)  # No rounding error carried into the next rows
+
+    def stats(self) -> dict:
+        result = {}
+        for metric, total, ordered in zip(SUMMARY_METRICS, self.sums, self.ordered):
+            if not ordered:
+                result[metric] = None
+                continue
+            result[metric] = {'mean': total / len(ordered), 'min': ordered[0], 'max': ordered[-1]}
+            for p in SUMMARY_PERCENTILES:
+                result[metric][f'p{p}'] = percentile(ordered, p)
+        return result
+
+class RollingSummary:
+    def __init__(self, windows: Dict[str, int] = SUMMARY_WINDOWS):
+        """Rolling statistics of the newest aggregated rows per device, for the dashboard header.
+
+        Each window is fed by the rows of one interval (choose_sources) as the
+        collector produces them, so a request reads precomputed figures
+        instead of pulling and summing series.
+        """
+        self.windows = windows
+        self.sources = {}  # window -> interval name
+        self._windows = {}  # (device, window) -> Window
+        self._lock = threading.Lock()
+
+    def warm(self, storage, intervals: Iterable[Sequence], devices: Iterable[str], now: float) -> None:
+        """Pick each window's interval and load its rows from the database.
+
+        Safe while the collector adds rows, so it also reloads after stored
+        rows or the intervals changed.
+        """
+        sources = choose_sources(intervals, self.windows)
+        devices = list(devices)
+        loaded = {}
+        for window, interval in sources.items():
+            for device in devices:
+                rows = storage.query(f'''SELECT timestamp, {', '.join(SUMMARY_METRICS)} FROM metrics
+                                     WHERE interval = ? AND device = ? AND timestamp > ?
+                                     ORDER BY timestamp''', (interval, device, now - self.windows[window]))
+                loaded[device, window] = rows
+        with self._lock:
+            previous, previous_sources = self._windows, self.sources
+            self._windows = {}
+            self.sources = sources
+            for (device, window), rows in loaded.items():
+                target = self._windows[device, window] = Window(self.windows[window])
+                for row in rows:
+                    target.add(row[0], tuple(row[1:]))
+                # Rows added while the query ran are newer than anything it returned
+                old = previous.get((device, window))
+                if old is not None and previous_sources.get(window) == sources[window]:
+                    for timestamp, values in old.rows:
+                        target.add(timestamp, values)
+
+    def add(self, interval: str, device: str, timestamp: int, row: Dict[str, float]) -> None:
+        """Count an aggregated row in every window its interval feeds"""
+        values = tuple(float(row[metric]) for metric in SUMMARY_METRICS)
+        with self._lock:
+            for window, source in self.sources.items():
+                if source != interval:
+                    continue
+                if (device, window) not in self._windows:
+                    self._windows[device, window] = Window(self.windows[window])
+                self._windows[device, window].add(timestamp, values)
+
+    def summary(self, now: float, device: Optional[str] = None) -> Dict[str, dict]:
+        """device -> window -> interval, rows, newest row timestamp and per-metric mean/min/max/percentiles"""
+        result = {}
+        with self._lock:
+            for (row_device, window), rows in self._windows.items():
+                if device is not None and row_device != device:
+                    continue
+                rows.expire(now)
+                entry = {'interval': self.sources[window], 'rows': len(rows.rows),
+                         'newest': rows.rows[-1][0] if rows.rows else None}
+                entry.update(rows.stats())
+                result.setdefault(row_device, {})[window] = entry
+        # Windows in SUMMARY_WINDOWS order, shortest first
+        return {name: {window: windows[window] for window in self.windows if window in windows}
+                for name, windows in sorted(result.items())}